@@ -4,32 +4,52 @@
 import io
 import sys
 import argparse
-import requests
-from requests.exceptions import HTTPError
 import six
 import json
 import re
 import email
 import logging
-from datetime import datetime
+import heapq
+import functools
+import itertools
+from operator import itemgetter
+import random
+import gzip
+import hashlib
+import bisect
+import calendar
+import mmap
+from array import array
+import threading
+import signal
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import namedtuple, deque, OrderedDict
+from datetime import datetime, timedelta
+import os
 from os import path
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 try:
     from urllib.parse import urlencode
     from urllib.parse import urlunparse
 except ImportError:
     from urllib import urlencode
     from urlparse import urlunparse
-from bs4 import BeautifulSoup
-from time import sleep, time, mktime
-from fake_useragent import UserAgent, settings as fake_useragent_settings
+from time import sleep, time, mktime, perf_counter
 
 
 
 __author__ = 'Tom Dickinson, Flavio Martins, David Semedo'
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 
 # Only needed in case user additional details are required
 # If that is the case, the library requires the package python-twitter
@@ -43,24 +63,603 @@ DEFAULT_ERROR_DELAY = 5
 DEFAULT_LIMIT = None
 MAX_RETRIES_SESSION = 5
 MAX_RETRIES = MAX_RETRIES_SESSION*5
+DEFAULT_TIMEOUT = 60  # seconds to wait for Twitter to respond
+# Sent when fake_useragent cannot load its database
+FALLBACK_USER_AGENT = "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:33.0) Gecko/20100101 Firefox/33.0"
+# User enrichment: users per users/lookup request, its rate limit (900 requests per 15 minutes), lookups in flight,
+# how long profiles are cached, and how many pages may wait for their users before the search blocks
+USER_LOOKUP_BATCH = 100
+USER_LOOKUP_RATE = 1.0
+DEFAULT_ENRICH_WORKERS = 4
+DEFAULT_PROFILE_TTL = 24 * 3600
+PROFILE_CACHE_SIZE = 100000
+MAX_WAITING_PAGES = 50
+DEFAULT_RETRY_BUDGET = 3600  # seconds a single request may spend retrying
 PROGRESS_PER = 100
 DEFAULT_TARGET_TYPE = "tweets"
 DATE_FORMAT = "%a %b %d %H:%M:%S +0000 %Y"  # "Fri Mar 29 11:03:41 +0000 2013";
+QUERY_DATE_FORMAT = "%Y-%m-%d"
+DEFAULT_WORKERS = 1
+DEFAULT_CONCURRENCY = 8
+# A slice is split in two once it has fetched this many pages
+DENSE_SLICE_PAGES = 25
+MIN_SLICE_SECONDS = 600  # slices shorter than this are searched to the end instead of split
+SLICE_RETRIES = 2  # times the part of a slice left after a request was given up on is searched again
+PARSERS = ("bs4", "lxml", "stream")
+DEFAULT_PARSER = "bs4"
+STREAM_CHUNK_SIZE = 64 * 1024  # characters of a page fed at a time to the stream parser
+DEFAULT_PARSE_WORKERS = 0
+# Pages fetched ahead of the writer when parsing runs in a process pool
+PIPELINE_DEPTH = 8
+CHECKPOINT_SUFFIX = ".checkpoint"
+SEEN_INDEX_DIR = ".seen_%s"  # One index per target type in the output directory
+# New ids kept in memory before they are written out as a sorted segment
+SEEN_INDEX_BUFFER = 200000
+DEFAULT_CACHE_SIZE = 1024 ** 3  # bytes of compressed pages kept by the page cache
+COMPRESSIONS = ("gzip", "zstd")
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+DEFAULT_BUFFER_SIZE = 1024 ** 2  # bytes of serialized items buffered before they are written out
+OUTPUT_FORMATS = ("jsonl", "parquet")
+DEFAULT_OUTPUT_FORMAT = "jsonl"
+DEFAULT_ROW_GROUP_PAGES = 50  # pages of items per Parquet row group
+# Rate limiter: requests per second to start from, burst size, and the AIMD steps
+DEFAULT_RATE_LIMIT = None
+RATE_LIMIT_BURST = 5
+RATE_LIMIT_INCREASE = 0.05
+RATE_LIMIT_DECREASE = 0.5
+RATE_LIMIT_MIN = 0.01
+# Metrics: histogram buckets in seconds and items, and how often metrics are written to a file
+METRICS_PREFIX = "twitter_search_"
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+PAGE_ITEMS_BUCKETS = (0, 1, 5, 10, 15, 20, 25, 50, 100)
+DEFAULT_METRICS_INTERVAL = 15
+# Crawl scheduler: the log of finished account searches in the output directory, and how accounts are ordered
+CRAWL_STATUS_FILE = ".crawl_status.jsonl"
+PRIORITIES = ("staleness", "volume")
+DEFAULT_PRIORITY = "staleness"
+HIGH_WATER_MARKS_FILE = ".high_water_marks.json"
+
+
+class User(object):
+    """
+    A user. The authors of tweets only carry id, screen_name and name. Users found by a users search also have bio
+    and verified, and details holds the fields added by retrieve_user_details.
+    """
+    __slots__ = ('id', 'screen_name', 'name', 'bio', 'verified', 'details')
+
+    def __init__(self, id, screen_name=None, name=None, bio=None, verified=None, details=None):
+        self.id = id
+        self.screen_name = screen_name
+        self.name = name
+        self.bio = bio
+        self.verified = verified
+        self.details = details
+
+    @property
+    def id_str(self):
+        return str(self.id)
+
+    def to_dict(self):
+        """
+        :return: The user as a dictionary, with the same keys and order as before users were records
+        """
+        if self.verified is None:
+            return {
+                'id_str': self.id_str,
+                'id': self.id,
+                'screen_name': self.screen_name,
+                'name': self.name,
+            }
+        user = {
+            'bio': self.bio,
+            'id_str': self.id_str,
+            'id': self.id,
+            'screen_name': self.screen_name,
+            'name': self.name,
+            'verified': self.verified,
+        }
+        if self.details:
+            user.update(self.details)
+        return user
+
+    @classmethod
+    def from_dict(cls, user):
+        """
+        :param user: A user dictionary, e.g. read back from JSON
+        :return: The user record
+        """
+        if 'verified' not in user:
+            return cls(user['id'], user['screen_name'], user['name'])
+        details = dict((key, value) for key, value in user.items() if key not in _USER_KEYS) or None
+        return cls(int(user['id_str']), user['screen_name'], user['name'], user['bio'], user['verified'], details)
+
+    def __getitem__(self, key):
+        return self.to_dict()[key] if key not in self.__slots__ else getattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __reduce__(self):
+        return User, (self.id, self.screen_name, self.name, self.bio, self.verified, self.details)
+
+    def __eq__(self, other):
+        return isinstance(other, User) and self.__reduce__() == other.__reduce__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "User(%r)" % self.to_dict()
+
+
+class Tweet(object):
+    """
+    A tweet. Fields derived from others, like created_at and id_str, are computed when they are read.
+    """
+    __slots__ = ('id', 'epoch', 'text', 'reply_count', 'retweet_count', 'favorite_count', 'hashtags', 'cards', 'urls',
+                 'photos', 'videos', 'user')
+
+    def __init__(self, id, epoch, text, reply_count, retweet_count, favorite_count, hashtags, cards, urls, photos,
+                 videos, user):
+        self.id = id
+        self.epoch = epoch
+        self.text = text
+        self.reply_count = reply_count
+        self.retweet_count = retweet_count
+        self.favorite_count = favorite_count
+        self.hashtags = hashtags
+        self.cards = cards
+        self.urls = urls
+        self.photos = photos
+        self.videos = videos
+        self.user = user
+
+    @property
+    def id_str(self):
+        return str(self.id)
+
+    @property
+    def created_at(self):
+        return datetime.utcfromtimestamp(self.epoch).strftime(DATE_FORMAT)
+
+    def to_dict(self):
+        """
+        :return: The tweet as a dictionary, with the same keys and order as before tweets were records
+        """
+        return {
+            'created_at': self.created_at,
+            'text': self.text,
+            'id': self.id,
+            'id_str': self.id_str,
+            'epoch': self.epoch,
+            'reply_count': self.reply_count,
+            'retweet_count': self.retweet_count,
+            'favorite_count': self.favorite_count,
+            'hashtags': self.hashtags,
+            'cards': self.cards,
+            'urls': self.urls,
+            'photos': self.photos,
+            'videos': self.videos,
+            'user': self.user.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, tweet):
+        """
+        :param tweet: A tweet dictionary, e.g. read back from JSON
+        :return: The tweet record
+        """
+        return cls(tweet['id'], tweet['epoch'], tweet['text'], tweet['reply_count'], tweet['retweet_count'],
+                   tweet['favorite_count'], tweet['hashtags'], tweet['cards'], tweet['urls'], tweet['photos'],
+                   tweet['videos'], User.from_dict(tweet['user']))
+
+    def __getitem__(self, key):
+        if key == 'user':
+            return self.user.to_dict()
+        if key in ('created_at', 'id_str') or key in self.__slots__:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __reduce__(self):
+        return Tweet, (self.id, self.epoch, self.text, self.reply_count, self.retweet_count, self.favorite_count,
+                       self.hashtags, self.cards, self.urls, self.photos, self.videos, self.user)
+
+    def __eq__(self, other):
+        return isinstance(other, Tweet) and self.__reduce__() == other.__reduce__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "Tweet(%r)" % self.to_dict()
+
+
+_USER_KEYS = frozenset(['bio', 'id_str', 'id', 'screen_name', 'name', 'verified'])
+
+
+def record_from_dict(item):
+    """
+    :param item: A tweet or user dictionary, e.g. read back from JSON
+    :return: The Tweet or User record
+    """
+    return Tweet.from_dict(item) if 'epoch' in item else User.from_dict(item)
+
+
+def item_to_dict(item):
+    """
+    :param item: A Tweet or User record, or an item that is already a dictionary
+    :return: The item as a dictionary
+    """
+    return item if isinstance(item, dict) else item.to_dict()
+
+
+def _has_class(name):
+    return "contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % name
+
+
+# lxml and the precompiled selectors of its parser backend are loaded by _load_lxml on first use
+etree = None
+_XPATH_TEXT = _XPATH_STREAM_ITEMS = _XPATH_USER_ITEMS = _XPATH_TIMELINE_LINK = _XPATH_HIDDEN = None
+_XPATH_NESTED_STREAM_ITEMS = _XPATH_NESTED_USER_ITEMS = None
+_XPATH_IFRAME_CONTAINER = _XPATH_USER_BIO = _XPATH_USER_ACTIONS = _XPATH_USER_FIELDS = _XPATH_USER_VERIFIED = None
+# Classes looked up inside each tweet by the lxml backend
+_TWEET_CLASSES = frozenset(['tweet-text', '_timestamp', 'tweet', 'ProfileTweet-actionCount', 'twitter-hashtag',
+                            'twitter-timeline-link', 'AdaptiveMedia-photoContainer', 'PlayableMedia-player', 'card2'])
+
+
+_ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+_PRESERVE_WHITESPACE_TAGS = frozenset(['pre', 'textarea'])
+
+
+def _load_lxml():
+    global etree, _XPATH_TEXT, _XPATH_STREAM_ITEMS, _XPATH_USER_ITEMS, _XPATH_TIMELINE_LINK, _XPATH_HIDDEN, \
+        _XPATH_IFRAME_CONTAINER, _XPATH_USER_BIO, _XPATH_USER_ACTIONS, _XPATH_USER_FIELDS, _XPATH_USER_VERIFIED, \
+        _XPATH_NESTED_STREAM_ITEMS, _XPATH_NESTED_USER_ITEMS
+    if etree is not None:
+        return
+    from lxml import etree as lxml_etree
+    # BeautifulSoup's get_text() leaves out the contents of these tags, so the lxml backend does the same to produce
+    # identical text.
+    _XPATH_TEXT = lxml_etree.XPath("descendant::text()[not(ancestor::script or ancestor::style or "
+                                   "ancestor::template or ancestor::rp or ancestor::rt)]")
+    _XPATH_STREAM_ITEMS = lxml_etree.XPath("//*[%s]" % _has_class('stream-item'))
+    _XPATH_USER_ITEMS = lxml_etree.XPath("//div[%s]" % _has_class('js-stream-item'))
+    _XPATH_NESTED_STREAM_ITEMS = lxml_etree.XPath("descendant::*[%s]" % _has_class('stream-item'))
+    _XPATH_NESTED_USER_ITEMS = lxml_etree.XPath("descendant::div[%s]" % _has_class('js-stream-item'))
+    _XPATH_TIMELINE_LINK = lxml_etree.XPath("descendant::a[%s]" % _has_class('twitter-timeline-link'))
+    _XPATH_HIDDEN = lxml_etree.XPath("descendant::*[%s]" % _has_class('u-hidden'))
+    _XPATH_IFRAME_CONTAINER = lxml_etree.XPath("descendant::*[%s]" % _has_class('js-macaw-cards-iframe-container'))
+    _XPATH_USER_BIO = lxml_etree.XPath("descendant::p[%s]" % _has_class('ProfileCard-bio'))
+    _XPATH_USER_ACTIONS = lxml_etree.XPath("descendant::div[%s]" % _has_class('user-actions'))
+    _XPATH_USER_FIELDS = lxml_etree.XPath("descendant::div[%s]" % _has_class('ProfileCard-userFields'))
+    _XPATH_USER_VERIFIED = lxml_etree.XPath("descendant::span[%s]" % _has_class('Icon--verified'))
+    # Set last, so other threads only skip the loading once everything is in place
+    etree = lxml_etree
+
+
+def _get_text(element):
+    # Like BeautifulSoup, collapse strings made only of whitespace to a newline or a space
+    strings = []
+    for string in _XPATH_TEXT(element):
+        if not string.strip(_ASCII_SPACES) and not _preserves_whitespace(string):
+            string = '\n' if '\n' in string else ' '
+        strings.append(string)
+    return ''.join(strings)
+
+
+def _preserves_whitespace(string):
+    node = string.getparent()
+    if string.is_tail:
+        node = node.getparent()
+    while node is not None:
+        if node.tag in _PRESERVE_WHITESPACE_TAGS:
+            return True
+        node = node.getparent()
+    return False
+
+
+def _first(elements):
+    return elements[0] if elements else None
+
+
+def _html_document(items_html):
+    if not items_html or not items_html.strip():
+        return None
+    _load_lxml()
+    import lxml.html
+    try:
+        return lxml.html.document_fromstring(items_html)
+    except etree.ParserError:
+        return None
+
+
+def _is_stream_item(element):
+    element_class = element.get('class')
+    return element_class is not None and 'stream-item' in element_class.split()
+
+
+def _is_user_item(element):
+    element_class = element.get('class')
+    return element.tag == 'div' and element_class is not None and 'js-stream-item' in element_class.split()
+
+
+def _iter_stream_items(items_html, is_item, nested_items, extract):
+    """
+    Parses the HTML incrementally with lxml. Each item is extracted as soon as it is complete, then dropped from the
+    tree, so only the item being parsed is kept in memory instead of the tree of the whole page.
+    :param items_html: The HTML block with items
+    :param is_item: Tells whether an element is an item
+    :param nested_items: Returns the items inside an item
+    :param extract: Called with each item element, returns its record or None
+    :return: A generator of records, in document order
+    """
+    if not items_html or not items_html.strip():
+        return
+    _load_lxml()
+    import lxml.html
+    parser = etree.HTMLPullParser(events=('end',))
+    parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+    for offset in itertools.chain(range(0, len(items_html), STREAM_CHUNK_SIZE), [None]):
+        if offset is not None:
+            parser.feed(items_html[offset:offset + STREAM_CHUNK_SIZE])
+        else:
+            try:
+                parser.close()
+            except etree.LxmlError:
+                pass
+        for _, element in parser.read_events():
+            # Items nested in another one are extracted with the outermost, in document order
+            if not is_item(element) or any(is_item(ancestor) for ancestor in element.iterancestors()):
+                continue
+            for item in itertools.chain([element], nested_items(element)):
+                record = extract(item)
+                if record is not None:
+                    yield record
+            # Free the item, and whatever came before it
+            element.clear()
+            parent = element.getparent()
+            if parent is not None:
+                while element.getprevious() is not None:
+                    del parent[0]
+
+
+def _count(node):
+    return int(_get_text(node).split(" ")[0].replace(',', "").replace('.', ""))
+
+
+def _lxml_tweet(tweet):
+    """
+    Extracts a tweet from its stream item with lxml, exactly like TwitterSearch.parse_tweets does with BeautifulSoup
+    :param tweet: The stream item element
+    :return: A tweet dictionary, or None if the item is not a tweet
+    """
+    id_str = tweet.get('data-item-id')
+    if id_str is None:
+        return None
+    id = int(id_str)
+
+    # Walk the item once and keep the elements of every class we need, in document order
+    nodes = {}
+    for node in tweet.iterdescendants(tag=etree.Element):
+        node_class = node.get('class')
+        if node_class:
+            for name in node_class.split():
+                if name in _TWEET_CLASSES:
+                    nodes.setdefault(name, []).append(node)
+
+    tweet_text = _first(nodes.get('tweet-text'))
+    if tweet_text is None:
+        return None
+
+    timestamp = int(nodes['_timestamp'][0].attrib['data-time'])
+
+    tweet_div = nodes['tweet'][0]
+    user = User(int(tweet_div.attrib['data-user-id']), tweet_div.attrib['data-screen-name'],
+                tweet_div.attrib['data-name'])
+
+    interactions = nodes['ProfileTweet-actionCount']
+    replies = _count(interactions[0])
+    retweets = _count(interactions[1])
+    likes = _count(interactions[2])
+    hashtags = [_get_text(hashtag_node) for hashtag_node in nodes.get('twitter-hashtag', ())]
+    urls = [url_node.get('data-expanded-url')
+            for url_node in nodes.get('twitter-timeline-link', ())
+            if url_node.tag == 'a' and 'data-expanded-url' in url_node.attrib]
+    photos = [photo_node.get('data-image-url')
+              for photo_node in nodes.get('AdaptiveMedia-photoContainer', ())
+              if 'data-image-url' in photo_node.attrib]
+
+    videos = []
+    if 'PlayableMedia-player' in nodes:
+        videos.append({
+            'expanded_url': 'https://twitter.com/i/videos/tweet/%s' % id_str
+        })
+
+    cards = []
+    for node in nodes.get('card2', ()):
+        card_type = node.get('data-card2-name', None)
+        if card_type is not None:  # Only care about media. Ignore Tweet Quotes, etc.
+            if 'summary' in card_type:  # Expanded URL w/ image
+                iframe_container = _first(_XPATH_IFRAME_CONTAINER(node))
+                if iframe_container is not None:
+                    timeline_link = _first(_XPATH_TIMELINE_LINK(tweet_text))
+                    if timeline_link is not None and 'data-expanded-url' in timeline_link.attrib:
+                        cards.append({
+                            'card_url': 'https://twitter.com' + iframe_container.attrib['data-src'],
+                            'expanded_url': timeline_link.get('data-expanded-url')
+                        })
+                    else:
+                        logger.error("BAD CARD: %s", id_str)
+            elif 'player' in card_type:  # Embedded video
+                timeline_link = _first(_XPATH_TIMELINE_LINK(tweet_text))
+                if timeline_link is not None and 'data-expanded-url' in timeline_link.attrib:
+                    videos.append({
+                        'expanded_url': timeline_link.get('data-expanded-url')
+                    })
+                else:
+                    logger.error("BAD CARD: %s", id_str)
+
+    # remove u-hidden links, etc
+    for hidden_child in _XPATH_HIDDEN(tweet_text):
+        hidden_child.drop_tree()
+    text = _get_text(tweet_text)
+
+    return Tweet(id, timestamp, text, replies, retweets, likes, hashtags, cards, urls, photos, videos, user)
+
+
+def _lxml_user(div):
+    """
+    Extracts a user from its stream item with lxml, exactly like TwitterSearch.parse_users does with BeautifulSoup
+    :param div: The stream item element
+    :return: A user dictionary, or None if the item is not a user
+    """
+    if div.get('data-item-id') is None:
+        return None
+
+    user = User(int(div.get('data-item-id')))
+
+    # User Bio
+    text_p = _first(_XPATH_USER_BIO(div))
+    if text_p is not None:
+        user.bio = _get_text(text_p)
+
+    # Tweet User ID, User Screen Name, User Name
+    user_details_div = _first(_XPATH_USER_ACTIONS(div))
+    if user_details_div is not None:
+        user.screen_name = user_details_div.attrib['data-screen-name']
+        user.name = user_details_div.attrib['data-name']
+
+    user_fields_div = _XPATH_USER_FIELDS(div)[0]
+    user.verified = True if _XPATH_USER_VERIFIED(user_fields_div) else False
+
+    return user
+
+
+class UserAgentList(object):
+    def __init__(self, user_agents):
+        """
+        Random User-Agents from a fixed list, in place of fake_useragent's UserAgent
+        :param user_agents: List of User-Agent strings
+        """
+        self.user_agents = list(user_agents)
+
+    @classmethod
+    def from_file(cls, filepath):
+        """
+        :param filepath: A file with one User-Agent per line. Blank lines and lines starting with # are skipped.
+        :return: A UserAgentList
+        """
+        with io.open(filepath, 'r', encoding='utf-8') as user_agents_file:
+            user_agents = [line.strip() for line in user_agents_file]
+        user_agents = [user_agent for user_agent in user_agents if user_agent and not user_agent.startswith('#')]
+        if not user_agents:
+            raise ValueError("No User-Agents in %s" % filepath)
+        return cls(user_agents)
+
+    @property
+    def random(self):
+        return random.choice(self.user_agents)
+
+
+_user_agents = {}
+_user_agents_lock = threading.Lock()
+
+
+def load_user_agent(useragent_cache_path=None, useragent_file=None):
+    """
+    Returns the User-Agent provider of this process for the given source, loading it on first use. It is shared by
+    every search, so the fake_useragent database or the User-Agent file is read once per process.
+    :param useragent_cache_path: Path of the fake_useragent database, by default the one of fake_useragent
+    :param useragent_file: A file with one User-Agent per line, used instead of fake_useragent
+    :return: A UserAgent or a UserAgentList
+    """
+    key = (useragent_cache_path, useragent_file)
+    with _user_agents_lock:
+        user_agent = _user_agents.get(key)
+        if user_agent is None:
+            if useragent_file is not None:
+                user_agent = UserAgentList.from_file(useragent_file)
+            else:
+                from fake_useragent import UserAgent, settings
+                user_agent = UserAgent(fallback=FALLBACK_USER_AGENT, path=useragent_cache_path or settings.DB)
+            _user_agents[key] = user_agent
+        return user_agent
+
+
+# A page of search results, and the max_position that selects the page after it
+Page = namedtuple('Page', ['items', 'max_position'])
+
 
 class TwitterSearch:
     __metaclass__ = ABCMeta
 
-    def __init__(self, session, rate_delay, error_delay=5, useragent_cache_path=fake_useragent_settings.DB):
+    def __init__(self, session, rate_delay, error_delay=5, useragent_cache_path=None, useragent_file=None,
+                 parser=DEFAULT_PARSER, parse_workers=DEFAULT_PARSE_WORKERS, cache=None, offline=False,
+                 rate_limiter=None, retry_engine=None, metrics=None, enricher=None, user_agent=None,
+                 cancel_event=None):
         """
         :param rate_delay: How long to pause between calls to Twitter
         :param error_delay: How long to pause when an error occurs
+        :param useragent_cache_path: Path of the fake_useragent database, by default the one of fake_useragent
+        :param useragent_file: A file with one User-Agent per line, used instead of fake_useragent
+        :param parser: Parser backend, "bs4", "lxml" or "stream"
+        :param parse_workers: Number of processes parsing pages while the next ones are fetched. 0 parses inline.
+        :param cache: A PageCache that keeps every page fetched
+        :param offline: Read pages from the cache only, without any network access
+        :param rate_limiter: A RateLimiter shared with other searches, that paces every request
+        :param retry_engine: A RetryEngine that decides how failed requests are retried
+        :param metrics: A Metrics that records requests, parsing, saving and retries
+        :param enricher: A UserEnricher for user_stats, shared with other searches
+        :param user_agent: A UserAgent to use, instead of the one of the process (see load_user_agent)
+        :param cancel_event: A threading.Event. Once it is set, the search stops after the page it is on.
         """
+        self.rate_limiter = rate_limiter
+        self.retry_engine = retry_engine if retry_engine is not None else RetryEngine(error_delay=error_delay)
+        self.metrics = metrics
+        self.enricher = enricher
+        if metrics is not None and metrics.on_retry not in self.retry_engine.listeners:
+            self.retry_engine.listeners.append(metrics.on_retry)
         self.session = session
         self.rate_delay = rate_delay
         self.error_delay = error_delay
-
-        self.UA = UserAgent(fallback='Mozilla/5.0 (Windows NT 6.1; WOW64; rv:33.0) Gecko/20100101 Firefox/33.0',
-                       path=useragent_cache_path)
+        self.parser = parser
+        self.parse_workers = parse_workers
+        self.cache = cache
+        self.offline = offline
+        self.cancel_event = cancel_event
+        # Set when a request is given up on, so the search ended without reaching the end of the results
+        self.failed = False
+
+        self.useragent_cache_path = useragent_cache_path
+        self.useragent_file = useragent_file
+        self.user_agent = user_agent
+
+    @property
+    def UA(self):
+        # Loaded on first use, searches that never send a request do not need it
+        if self.user_agent is None:
+            self.user_agent = load_user_agent(self.useragent_cache_path, self.useragent_file)
+        return self.user_agent
+
+    def cancelled(self):
+        """
+        :return: True if the search was asked to stop
+        """
+        return self.cancel_event is not None and self.cancel_event.is_set()
 
     def search(self, query, target_type, **kwargs):
         """
@@ -69,94 +668,270 @@ class TwitterSearch:
                         advanced search: https://twitter.com/search-advanced
         :param target_type:    Can be "tweets" or "users"
         """
-        url = self.construct_url(query, target_type=target_type, language=kwargs['language'])
-        continue_search = True
-        min_item = None
+        if self.parse_workers:
+            return self.pipeline_search(query, target_type, **kwargs)
+
+        pages = self.iter_pages(query, target_type, **kwargs)
+        try:
+            for page in pages:
+                continue_search = self.save_page(page.items)
+                self.checkpoint(page.max_position)
+                if not continue_search:
+                    break
+        finally:
+            pages.close()
+
+    def iter_pages(self, query, target_type, **kwargs):
+        """
+        Scrape pages of items from twitter lazily. The next page is only fetched once the caller asks for it, so
+        breaking out of the loop ends the search without any further request.
+        :param query:   Query to search Twitter with
+        :param target_type:    Can be "tweets" or "users"
+        :param kwargs: max_position to start from, language, and user_stats to look up the details of users
+        :return: A generator of Pages. If a request is given up on, it ends early and failed is set.
+        """
+        self.failed = False
+        # An offline search sends no request, so it needs no headers nor user agent
+        if not self.offline:
+            self.session.headers.update(self.search_headers())
+
+        min_item = kwargs.get('max_position')
+        url = self.construct_url(query, target_type=target_type, max_position=min_item,
+                                 language=kwargs.get('language'))
 
         # Initialize search function wrapper according to the target type
-        parse_tweets_fn = self.parse_tweets if target_type == DEFAULT_TARGET_TYPE else self.parse_users
+        parse_tweets_fn = self.item_parser(target_type)
 
         response = self.execute_search(url)
-        while response is not None and continue_search and response['items_html'] is not None:
-            items = parse_tweets_fn(response['items_html'])
+        while response is not None and response['items_html'] is not None and not self.cancelled():
+            items = self.parse_page(parse_tweets_fn, response['items_html'])
 
             # Check if we should collect additional user details
-            if target_type == "users" and kwargs["user_stats"]:
+            if target_type == "users" and kwargs.get("user_stats"):
                 self.retrieve_user_details(items)
 
             # If we have no items, then we can break the loop early
             if len(items) == 0:
                 break
 
-            continue_search = self.save_items(items)
-
             max_item = response["min_position"]
+            yield Page(items, max_item)
+
+            if max_item is None or max_item == min_item or self.cancelled():
+                break
+            url = self.construct_url(query, target_type=target_type, max_position=max_item,
+                                     language=kwargs.get('language'))
+            # Sleep for our rate_delay
+            sleep(self.rate_delay)
+            response = self.execute_search(url)
+            min_item = max_item
+
+    def iter_search(self, query, target_type=DEFAULT_TARGET_TYPE, **kwargs):
+        """
+        Scrape items from twitter lazily, one at a time, without saving them. Like iter_pages(), a page is only
+        fetched once the items before it are consumed.
+        :param query:   Query to search Twitter with
+        :param target_type:    Can be "tweets" or "users"
+        :param kwargs: Passed on to iter_pages()
+        :return: A generator of Tweet or User records
+        """
+        pages = self.iter_pages(query, target_type, **kwargs)
+        try:
+            for page in pages:
+                for item in page.items:
+                    yield item
+        finally:
+            pages.close()
 
-            if min_item is not max_item:
-                url = self.construct_url(query, target_type=target_type, max_position=max_item,
+    def pipeline_search(self, query, target_type, **kwargs):
+        """
+        Scrape items from twitter, fetching, parsing and saving pages concurrently.
+        This thread fetches pages and hands their HTML to a pool of parse_workers processes. A writer thread saves
+        the parsed pages in the order they were fetched, so the output and the max_items cutoff are the same as
+        with search(). At most PIPELINE_DEPTH pages wait for the writer, after which fetching blocks.
+        :param query:   Query to search Twitter with
+        :param target_type:    Can be "tweets" or "users"
+        """
+        self.failed = False
+        # An offline search sends no request, so it needs no headers nor user agent
+        if not self.offline:
+            self.session.headers.update(self.search_headers())
+        parse_tweets_fn = self.item_parser(target_type)
+        pages = queue.Queue(maxsize=PIPELINE_DEPTH)
+        stop = threading.Event()
+        errors = []
+
+        def write():
+            while True:
+                page = pages.get()
+                if page is None:
+                    break
+                future, max_item = page
+                # Keep draining after we stop so the fetcher never blocks on a full queue
+                if stop.is_set():
+                    continue
+                try:
+                    items, seconds = future.result()
+                    if self.metrics is not None:
+                        self.metrics.observe_parse(seconds, len(items))
+
+                    # Check if we should collect additional user details
+                    if target_type == "users" and kwargs.get("user_stats"):
+                        self.retrieve_user_details(items)
+
+                    # If we have no items, or the items are saved and we're done, then we stop fetching
+                    if len(items) == 0 or not self.save_page(items):
+                        stop.set()
+                    if len(items) > 0:
+                        self.checkpoint(max_item)
+                except Exception as e:
+                    errors.append(e)
+                    stop.set()
+
+        # Imports multiprocessing, which searches without parse workers do not need
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=self.parse_workers) as executor:
+            writer = threading.Thread(target=write, name="pipeline-writer")
+            writer.start()
+            try:
+                min_item = kwargs.get('max_position')
+                url = self.construct_url(query, target_type=target_type, max_position=min_item,
                                          language=kwargs['language'])
-                # Sleep for our rate_delay
-                sleep(self.rate_delay)
                 response = self.execute_search(url)
-                min_item = max_item
+                while response is not None and not stop.is_set() and response['items_html'] is not None:
+                    max_item = response["min_position"]
+                    pages.put((executor.submit(timed_call, parse_tweets_fn, response['items_html']), max_item))
+                    if self.metrics is not None:
+                        self.metrics.set_queue_depth("pipeline", pages.qsize())
+
+                    # The next page does not depend on parsing, only on the cursor
+                    if max_item is None or max_item == min_item or self.cancelled():
+                        break
+                    url = self.construct_url(query, target_type=target_type, max_position=max_item,
+                                             language=kwargs['language'])
+                    # Sleep for our rate_delay
+                    sleep(self.rate_delay)
+                    response = self.execute_search(url)
+                    min_item = max_item
+            finally:
+                pages.put(None)
+                writer.join()
+
+        if errors:
+            raise errors[0]
+
+    def parse_page(self, parse_fn, items_html):
+        """
+        Parses a page, recording how long it took
+        :param parse_fn: The parser, see item_parser()
+        :param items_html: The HTML block with items
+        :return: The items of the page
+        """
+        if self.metrics is None:
+            return parse_fn(items_html)
+        items, seconds = timed_call(parse_fn, items_html)
+        self.metrics.observe_parse(seconds, len(items))
+        return items
 
-    def execute_search(self, url, retry_num=0):
+    def save_page(self, items):
         """
-        Executes a search to Twitter for the given URL
+        Saves a page of items with save_items(), recording how long it took
+        :param items: The items of the page
+        :return: True to continue the search
+        """
+        if self.metrics is None:
+            return self.save_items(items)
+        continue_search, seconds = timed_call(self.save_items, items)
+        self.metrics.observe_save(seconds, len(items))
+        return continue_search
+
+    def execute_search(self, url):
+        """
+        Executes a search to Twitter for the given URL, retrying failed requests as the retry engine decides
         :param url: URL to search twitter with
-        :param retry_num: Retry number of current function call
         :return: A JSON object with data from Twitter
         """
-        try:
-            logger.info("URL: " + url)
-            response = self.session.get(url)
-            response.raise_for_status()  # raise on any HTTPError
-            data = response.json()
-            return data
-        # If we get a HTTPError exception due to a request timing out, we sleep for our error delay, then make
-        # another attempt
-        except HTTPError as e:
-            # 400 Bad Request
-            if e.response.status_code == 400:
-                logger.debug("HTTP 400 - Bad request")
-                return e.response.json()
-            elif e.response.status_code == 429:
-                now_ts = datetime.utcnow().timestamp()
-                logger.debug("HTTP 429 - Too many requests")
-                logger.debug(e.response.headers)
-                utc_reset_ts = int(e.response.headers['x-rate-limit-reset'])
-                reset = utc_reset_ts - now_ts
-                logger.debug("Reset time: %s", str(reset))
-                # Multiply by error delay for paranoid reasons.
-                seconds = reset * self.error_delay
-                logger.debug("Going to sleep for %s seconds.", str(seconds))
-                sleep(seconds)
+        if self.offline:
+            return self.cache.get(url)
+
+        import requests
+        from requests.exceptions import HTTPError
+        retry = self.retry_engine.start(self, url)
+        while True:
+            status = headers = kind = None
+            try:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire()
+                logger.debug("URL: %s", url)
+                if self.metrics is not None:
+                    started = perf_counter()
+                response = self.session.get(url, timeout=DEFAULT_TIMEOUT)
+                if self.metrics is not None:
+                    self.metrics.observe_request(perf_counter() - started, response.status_code,
+                                                 len(response.content))
+                response.raise_for_status()  # raise on any HTTPError
+                data = response.json()
+                if self.rate_limiter is not None:
+                    self.rate_limiter.on_success(response.headers)
+                if self.cache is not None:
+                    self.cache.put(url, data)
+                return data
+            except HTTPError as e:
+                status = e.response.status_code
+                headers = e.response.headers
+                # 400 Bad Request
+                if status == 400:
+                    logger.debug("HTTP 400 - Bad request")
+                    return e.response.json()
+                elif status == 429 and self.rate_limiter is not None:
+                    # The limiter holds back every search until the reset, so there is nothing left to wait for here
+                    self.rate_limiter.on_throttle(headers)
+                    headers = None
+            except requests.exceptions.Timeout:
+                kind = "timeout"
+            except requests.exceptions.ConnectionError:
+                kind = "connection"
+            if kind is not None and self.metrics is not None:
+                self.metrics.observe_request(perf_counter() - started, kind, 0)
+
+            delay = retry.next_delay(status=status, kind=kind, headers=headers)
+            if delay is None:
+                self.failed = True
+                return None
+            sleep(delay)
+
+    @staticmethod
+    def rate_limit_reset(headers):
+        """
+        Seconds until the rate limit window resets
+        :param headers: Headers of a HTTP 429 response
+        :return: Number of seconds
+        """
+        # The reset is in epoch seconds, which time() is as well whatever the local timezone
+        return int(headers['x-rate-limit-reset']) - time()
+
+    @staticmethod
+    def retry_after_seconds(headers):
+        """
+        Seconds to wait before retrying, taken from the Retry-After header when present
+        :param headers: Headers of an error response
+        :return: Number of seconds
+        """
+        retry_after = headers.get('retry-after', None)
+        reset_seconds = 1
+
+        if retry_after is not None:
+            if re.match("([0-9])+", retry_after):
+                reset_seconds = int(retry_after)
             else:
-                retry_after = e.response.headers.get('retry-after', None)
-                reset_seconds = 1
+                retry_after_tuple = email.utils.parsedate(retry_after)
+                if retry_after_tuple is None:
+                    logger.error("Invalid Retry-After header: %s" % retry_after)
+                else:
+                    retry_date = mktime(retry_after_tuple)
+                    reset_seconds = retry_date - time()
 
-                if retry_after is not None:
-                    if re.match("([0-9])+", retry_after):
-                        reset_seconds = int(retry_after)
-                    else:
-                        retry_after_tuple = email.utils.parsedate(retry_after)
-                        if retry_after_tuple is None:
-                            logger.error("Invalid Retry-After header: %s" % retry_after)
-                        retry_date = mktime(retry_after_tuple)
-                        reset_seconds = retry_date - time()
-
-                logger.error(e.response.headers)
-                logger.error(e.response.message)
-                total_sleep = reset_seconds * self.error_delay
-                logger.info("Sleeping for %i", total_sleep)
-                sleep(total_sleep)
-
-                if retry_num % MAX_RETRIES_SESSION == 0 and retry_num > 0:
-                    headers = {'User-Agent': self.UA.random}
-                    self.session.headers.update(headers)
-                elif retry_num == MAX_RETRIES:
-                    return None
-            return self.execute_search(url, retry_num + 1)
+        return reset_seconds
 
     @staticmethod
     def parse_tweets(items_html):
@@ -165,6 +940,7 @@ class TwitterSearch:
         :param items_html: The HTML block with tweets
         :return: A JSON list of tweets
         """
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(items_html, 'lxml')
 
         comma = ','
@@ -182,15 +958,10 @@ class TwitterSearch:
                 continue
 
             timestamp = int(tweet.find(class_="_timestamp").attrs['data-time'])
-            created_at = datetime.utcfromtimestamp(timestamp).strftime(DATE_FORMAT)
 
             tweet_div = tweet.find(class_="tweet")
-            user = {
-                'id_str': tweet_div.attrs['data-user-id'],
-                'id': int(tweet_div.attrs['data-user-id']),
-                'screen_name': tweet_div.attrs['data-screen-name'],
-                'name': tweet_div.attrs['data-name'],
-            }
+            user = User(int(tweet_div.attrs['data-user-id']), tweet_div.attrs['data-screen-name'],
+                        tweet_div.attrs['data-name'])
 
             interactions = [x.get_text() for x in tweet.find_all(class_='ProfileTweet-actionCount')]
             replies = int(interactions[0].split(" ")[0].replace(comma, "").replace(dot, ""))
@@ -242,22 +1013,8 @@ class TwitterSearch:
                 hidden_child.decompose()
             text = tweet_text.get_text()
 
-            tweets.append({
-                'created_at': created_at,
-                'text': text,
-                'id': id,
-                'id_str': id_str,
-                'epoch': timestamp,
-                'reply_count': replies,
-                'retweet_count': retweets,
-                'favorite_count': likes,
-                'hashtags': hashtags,
-                'cards': cards,
-                'urls': urls,
-                'photos': photos,
-                'videos': videos,
-                'user': user,
-            })
+            tweets.append(Tweet(id, timestamp, text, replies, retweets, likes, hashtags, cards, urls, photos, videos,
+                                user))
         return tweets
 
     @staticmethod
@@ -267,6 +1024,7 @@ class TwitterSearch:
         :param items_html: The HTML block with items
         :return: A JSON list of items
         """
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(items_html, 'lxml')
         items = []
         for div in soup.find_all("div", class_='js-stream-item'):
@@ -275,32 +1033,96 @@ class TwitterSearch:
             if 'data-item-id' not in div.attrs:
                 continue
 
-            user = {
-                'bio': None,
-                'id_str': div['data-item-id'],
-                'id': int(div['data-item-id']),
-                'screen_name': None,
-                'name': None,
-            }
+            user = User(int(div['data-item-id']))
 
             # User Bio
             text_p = div.find("p", class_="ProfileCard-bio")
             if text_p is not None:
-                user['bio'] = text_p.get_text()
+                user.bio = text_p.get_text()
 
             # Tweet User ID, User Screen Name, User Name
             user_details_div = div.find("div", class_="user-actions")
             if user_details_div is not None:
-                user['screen_name'] = user_details_div['data-screen-name']
-                user['name'] = user_details_div['data-name']
+                user.screen_name = user_details_div['data-screen-name']
+                user.name = user_details_div['data-name']
 
             user_fields_div = div.find("div", class_="ProfileCard-userFields")
             user_verified_span = user_fields_div.find("span", class_="Icon--verified")
-            user['verified'] = True if user_verified_span else False
+            user.verified = True if user_verified_span else False
 
             items.append(user)
         return items
 
+    @staticmethod
+    def parse_tweets_lxml(items_html):
+        """
+        Parses Tweets from the given HTML with lxml. Produces the same tweets as parse_tweets, faster.
+        :param items_html: The HTML block with tweets
+        :return: A JSON list of tweets
+        """
+        document = _html_document(items_html)
+        if document is None:
+            return []
+
+        tweets = []
+        for stream_item in _XPATH_STREAM_ITEMS(document):
+            tweet = _lxml_tweet(stream_item)
+            if tweet is not None:
+                tweets.append(tweet)
+        return tweets
+
+    @staticmethod
+    def parse_users_lxml(items_html):
+        """
+        Parses Users from the given HTML with lxml. Produces the same users as parse_users, faster.
+        :param items_html: The HTML block with items
+        :return: A JSON list of items
+        """
+        document = _html_document(items_html)
+        if document is None:
+            return []
+
+        items = []
+        for div in _XPATH_USER_ITEMS(document):
+            user = _lxml_user(div)
+            if user is not None:
+                items.append(user)
+        return items
+
+    @staticmethod
+    def parse_tweets_stream(items_html):
+        """
+        Parses Tweets from the given HTML with lxml, one at a time, without building the tree of the whole page.
+        Produces the same tweets as parse_tweets_lxml.
+        :param items_html: The HTML block with tweets
+        :return: A JSON list of tweets
+        """
+        return list(_iter_stream_items(items_html, _is_stream_item, lambda item: _XPATH_NESTED_STREAM_ITEMS(item),
+                                       _lxml_tweet))
+
+    @staticmethod
+    def parse_users_stream(items_html):
+        """
+        Parses Users from the given HTML with lxml, one at a time, without building the tree of the whole page.
+        Produces the same users as parse_users_lxml.
+        :param items_html: The HTML block with items
+        :return: A JSON list of items
+        """
+        return list(_iter_stream_items(items_html, _is_user_item, lambda item: _XPATH_NESTED_USER_ITEMS(item),
+                                       _lxml_user))
+
+    def item_parser(self, target_type):
+        """
+        Selects the parse function for the target type and the parser backend of this search
+        :param target_type:    Can be "tweets" or "users"
+        :return: A function that takes items_html and returns a list of items
+        """
+        if self.parser == "lxml":
+            return self.parse_tweets_lxml if target_type == DEFAULT_TARGET_TYPE else self.parse_users_lxml
+        if self.parser == "stream":
+            return self.parse_tweets_stream if target_type == DEFAULT_TARGET_TYPE else self.parse_users_stream
+        return self.parse_tweets if target_type == DEFAULT_TARGET_TYPE else self.parse_users
+
     @staticmethod
     def construct_url(query, target_type, max_position=None, language=None):
         """
@@ -353,6 +1175,26 @@ class TwitterSearch:
         url_tupple = ('https', 'twitter.com', '/i/search/timeline', '', urlencode(params), '')
         return urlunparse(url_tupple)
 
+    def rotate_user_agent(self):
+        """
+        Switches to another random User-Agent for the next requests
+        """
+        self.session.headers.update({'User-Agent': self.UA.random})
+
+    def search_headers(self):
+        """
+        Headers sent with every search request
+        :return: A dictionary of headers
+        """
+        # Specify a user agent to prevent Twitter from returning a profile card
+        return {
+            'Accept': 'application/json, text/javascript, */*; q=0.01',
+            'Referer': 'https://twitter.com/search',
+            'User-Agent': self.UA.random,
+            'X-Twitter-Active-User': 'yes',
+            'X-Requested-With': 'XMLHttpRequest'
+        }
+
     @abstractmethod
     def save_items(self, items):
         """
@@ -360,90 +1202,1896 @@ class TwitterSearch:
         When implementing this class, you can do whatever you want with these items.
         """
 
+    def checkpoint(self, max_position, done=False):
+        """
+        Called after each batch of items is saved, with the cursor of the next page.
+        Override it to make a search resumable.
+        :param max_position: The max_position value that selects the next page, passed to search() to resume
+        :param done: True when the search is complete
+        """
+
     def retrieve_user_details(self, items):
         """
         For a given set of crawled users, retrieves additional information using the Twitter REST API
-        :param items: A list of user dictionarities
-        :return: An updated list with additional fields of User dictionaries
+        :param items: A list of User records
+        :return: The same list, with the additional fields in each User's details
+        """
+        if self.enricher is None:
+            self.enricher = UserEnricher()
+        return self.enricher.enrich(items)
+
+
+class UserEnricher(object):
+    def __init__(self, lookup_fn=None, batch_size=USER_LOOKUP_BATCH, workers=DEFAULT_ENRICH_WORKERS,
+                 rate_limiter=None, ttl=DEFAULT_PROFILE_TTL, cache_size=PROFILE_CACHE_SIZE):
+        """
+        Adds the profiles of the Twitter REST API to users. Ids are collected across pages and looked up in full
+        batches, by a pool of threads paced by a rate limiter. Profiles are cached, so a user is looked up once per
+        ttl however many pages it is seen on. One UserEnricher can be shared by many searches.
+        :param lookup_fn: Called with a list of user ids, returns their profiles as dictionaries with an "id".
+                          By default, the users/lookup endpoint through one python-twitter client.
+        :param batch_size: Number of ids per lookup, at most 100 for users/lookup
+        :param workers: Number of lookups in flight
+        :param rate_limiter: A RateLimiter pacing the lookups, by default one of USER_LOOKUP_RATE requests/s
+        :param ttl: Seconds a profile is kept in the cache
+        :param cache_size: Number of profiles cached, after which expired and then the oldest ones are dropped
         """
-        # The user lookup API limit per request is 100
-        step = 100
+        self.lookup_fn = lookup_fn if lookup_fn is not None else self.twitter_lookup()
+        self.batch_size = batch_size
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter(USER_LOOKUP_RATE, burst=1)
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        # Profiles by user id, with the time they expire. Users the API did not return are cached as None.
+        self.profiles = {}
+        # Ids waiting for the next batch or being looked up, and the lookups in flight
+        self.batch = []
+        self.pending = set()
+        self.futures = set()
 
+    @staticmethod
+    def twitter_lookup():
         import twitter
         api = twitter.Api(consumer_key=TWITTER_REST_API_CONSUMER_KEY,
                           consumer_secret=TWITTER_REST_API_CONSUMER_SECRET,
                           access_token_key=TWITTER_REST_API_ACCESS_TOKEN,
                           access_token_secret=TWITTER_REST_API_ACCESS_TOKEN_SECRET)
 
-        for i in range(0, len(items), step):
-            statuses = api.UsersLookup(screen_name=[item["screen_name"] for item in items[i:step]])
-            for j in range(min(len(statuses), step)):
-                items[i + j] = {**items[i + j], **statuses[j].AsDict()}
+        def lookup(user_ids):
+            return [user.AsDict() for user in api.UsersLookup(user_id=user_ids)]
+        return lookup
+
+    def submit(self, items):
+        """
+        Queues the users that are not cached for lookup, and starts the lookups of every full batch
+        :param items: A list of User records
+        """
+        now = time()
+        with self.lock:
+            for item in items:
+                cached = self.profiles.get(item.id)
+                if item.id in self.pending or (cached is not None and cached[0] > now):
+                    continue
+                self.pending.add(item.id)
+                self.batch.append(item.id)
+            while len(self.batch) >= self.batch_size:
+                self._dispatch()
+
+    def _dispatch(self):
+        user_ids = self.batch[:self.batch_size]
+        del self.batch[:self.batch_size]
+        future = self.executor.submit(self._lookup, user_ids)
+        self.futures.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self.lock:
+            self.futures.discard(future)
+
+    def _lookup(self, user_ids):
+        self.rate_limiter.acquire()
+        try:
+            profiles = self.lookup_fn(user_ids)
+        except Exception:
+            logger.exception("Looking up %i users failed.", len(user_ids))
+            with self.lock:
+                self.pending.difference_update(user_ids)
+            return
+
+        expires = time() + self.ttl
+        with self.lock:
+            for user_id in user_ids:
+                self.profiles[user_id] = (expires, None)
+            # Merge by id, the API leaves out suspended users and does not keep the order
+            for profile in profiles:
+                self.profiles[int(profile['id'])] = (expires, profile)
+            self.pending.difference_update(user_ids)
+            if len(self.profiles) > self.cache_size:
+                self._evict()
+
+    def _evict(self):
+        now = time()
+        for user_id in [user_id for user_id, (expires, _) in self.profiles.items() if expires <= now]:
+            del self.profiles[user_id]
+        # Profiles are inserted in the order they were looked up, so the first ones are the oldest
+        excess = len(self.profiles) - self.cache_size
+        for user_id in list(self.profiles)[:max(excess, 0)]:
+            del self.profiles[user_id]
+
+    def ready(self, items):
+        """
+        :param items: A list of User records, submitted before
+        :return: True if none of the users is still being looked up
+        """
+        with self.lock:
+            return not any(item.id in self.pending for item in items)
 
+    def apply(self, items):
+        """
+        Sets the details of every user to its cached profile
+        :param items: A list of User records
+        :return: The same list
+        """
+        with self.lock:
+            for item in items:
+                cached = self.profiles.get(item.id)
+                if cached is not None and cached[1] is not None:
+                    item.details = cached[1]
         return items
 
+    def wait(self, items=None):
+        """
+        Looks up whatever is left in the current batch and waits for the lookups of the given users
+        :param items: A list of User records, or None to wait for every lookup
+        """
+        while not (self.ready(items) if items is not None else not self.pending):
+            with self.lock:
+                if self.batch:
+                    self._dispatch()
+                futures = list(self.futures)
+            wait(futures, return_when=FIRST_COMPLETED)
+
+    def enrich(self, items):
+        """
+        Looks up the users and adds their profiles, blocking until done
+        :param items: A list of User records
+        :return: The same list
+        """
+        self.submit(items)
+        self.wait(items)
+        return self.apply(items)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+RetryEvent = namedtuple('RetryEvent', ['url', 'kind', 'status', 'attempt', 'delay', 'elapsed', 'action'])
+
+
+def log_retry_event(event):
+    if event.action == "retry":
+        logger.info("Retry %i of %s (%s) in %.1fs : %s", event.attempt, event.kind, event.status, event.delay,
+                    event.url)
+    else:
+        logger.error("Giving up after %i retries of %s (%s) and %.1fs : %s", event.attempt - 1, event.kind,
+                     event.status, event.elapsed, event.url)
+
+
+class RetryPolicy(object):
+    def __init__(self, max_attempts=MAX_RETRIES, base=1, cap=300, use_headers=True):
+        """
+        How one kind of failure is retried. Delays follow decorrelated jitter: each one is drawn between base and
+        three times the previous delay, up to cap.
+        :param max_attempts: Number of retries before giving up
+        :param base: Smallest delay in seconds
+        :param cap: Largest delay in seconds
+        :param use_headers: Wait at least as long as Retry-After asks for, or x-rate-limit-reset on HTTP 429
+        """
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+        self.use_headers = use_headers
+
+
+class RotateUserAgent(object):
+    def __init__(self, every=MAX_RETRIES_SESSION):
+        """
+        Switches the search to another User-Agent every few retries
+        :param every: Number of retries between switches
+        """
+        self.every = every
+
+    def __call__(self, search, event):
+        if event.attempt % self.every == 0:
+            search.rotate_user_agent()
+
+
+def default_retry_policies(error_delay=DEFAULT_ERROR_DELAY):
+    """
+    :param error_delay: Smallest delay after an error
+    :return: Retry policies by status code, "5xx", "timeout", "connection" and "default" for everything else
+    """
+    return {
+        429: RetryPolicy(base=1, cap=900),
+        "5xx": RetryPolicy(base=error_delay),
+        "timeout": RetryPolicy(base=error_delay),
+        "connection": RetryPolicy(base=error_delay),
+        "default": RetryPolicy(max_attempts=MAX_RETRIES_SESSION, base=error_delay, cap=60),
+    }
+
+
+class RetryEngine(object):
+    def __init__(self, policies=None, error_delay=DEFAULT_ERROR_DELAY, budget=DEFAULT_RETRY_BUDGET,
+                 on_retry=RotateUserAgent(), listeners=(log_retry_event,)):
+        """
+        Decides whether and when failed requests are retried
+        :param policies: RetryPolicy by status code or kind of failure, see default_retry_policies()
+        :param error_delay: Smallest delay of the default policies
+        :param budget: Seconds a single request may spend, retries included
+        :param on_retry: Called with the search and the RetryEvent before each retry, e.g. to switch User-Agent
+        :param listeners: Called with every RetryEvent
+        """
+        self.policies = policies if policies is not None else default_retry_policies(error_delay)
+        self.budget = budget
+        self.on_retry = on_retry
+        self.listeners = list(listeners)
+
+    def policy(self, status=None, kind=None):
+        """
+        :return: The kind of failure and its RetryPolicy
+        """
+        if kind is None:
+            if status in self.policies:
+                kind = status
+            elif status is not None and 500 <= status < 600:
+                kind = "5xx"
+            else:
+                kind = "default"
+        return kind, self.policies.get(kind, self.policies["default"])
+
+    def start(self, search, url):
+        """
+        :return: A RetryState that tracks the retries of one request
+        """
+        return RetryState(self, search, url)
+
+
+class RetryState(object):
+    def __init__(self, engine, search, url):
+        self.engine = engine
+        self.search = search
+        self.url = url
+        self.started = time()
+        self.attempt = 0
+        self.previous_delay = None
+
+    def next_delay(self, status=None, kind=None, headers=None):
+        """
+        Called after a failed attempt
+        :param status: HTTP status of the response, if there was one
+        :param kind: "timeout" or "connection" when the request failed without a response
+        :param headers: Headers of the response, to honour Retry-After and x-rate-limit-reset
+        :return: Seconds to wait before retrying, or None to give up
+        """
+        kind, policy = self.engine.policy(status, kind)
+        self.attempt += 1
+        elapsed = time() - self.started
+
+        previous_delay = self.previous_delay if self.previous_delay is not None else policy.base
+        delay = min(policy.cap, random.uniform(policy.base, previous_delay * 3))
+        if policy.use_headers and headers is not None:
+            # Other errors can carry the rate limit headers too, but only a 429 has to wait for the window to reset
+            if status == 429 and 'x-rate-limit-reset' in headers:
+                delay = max(delay, TwitterSearch.rate_limit_reset(headers))
+            elif 'retry-after' in headers:
+                delay = max(delay, TwitterSearch.retry_after_seconds(headers))
+        self.previous_delay = delay
+
+        if self.attempt > policy.max_attempts or elapsed + delay > self.engine.budget:
+            self.emit(RetryEvent(self.url, kind, status, self.attempt, None, elapsed, "give_up"))
+            return None
+
+        event = RetryEvent(self.url, kind, status, self.attempt, delay, elapsed, "retry")
+        self.emit(event)
+        if self.engine.on_retry is not None:
+            self.engine.on_retry(self.search, event)
+        return delay
+
+    def emit(self, event):
+        for listener in self.engine.listeners:
+            listener(event)
+
+
+class RateLimiter(object):
+    def __init__(self, rate=1.0, burst=RATE_LIMIT_BURST, increase=RATE_LIMIT_INCREASE,
+                 decrease=RATE_LIMIT_DECREASE, min_rate=RATE_LIMIT_MIN, state_path=None):
+        """
+        Token bucket shared by all the searches of a process, and optionally by several processes through a state
+        file. The rate grows additively after each successful request and is cut multiplicatively on HTTP 429
+        (AIMD), and it never exceeds the budget advertised by the x-rate-limit-* headers.
+        :param rate: Requests per second to start from
+        :param burst: Maximum number of requests sent back to back
+        :param increase: Requests per second added after each successful request
+        :param decrease: Factor applied to the rate on HTTP 429
+        :param min_rate: Lowest rate the limiter backs off to
+        :param state_path: File that holds the bucket, to share it with other processes. Needs fcntl.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.min_rate = min_rate
+        self.ceiling = None
+        self.tokens = burst
+        self.updated = time()
+        self.blocked_until = 0
+        self.state_path = state_path if fcntl is not None else None
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def _state(self):
+        """
+        Holds the bucket for an update, reloading and saving it when it is shared through a state file
+        """
+        with self.lock:
+            if self.state_path is None:
+                yield
+                return
+            with io.open(self.state_path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    try:
+                        with io.open(self.state_path, 'r', encoding='utf-8') as state_file:
+                            self.__dict__.update(json.load(state_file))
+                    except (IOError, OSError, ValueError):
+                        pass
+                    yield
+                    state = dict((key, getattr(self, key))
+                                 for key in ('rate', 'ceiling', 'tokens', 'updated', 'blocked_until'))
+                    with io.open(self.state_path, 'w', encoding='utf-8') as state_file:
+                        state_file.write(six.text_type(json.dumps(state)))
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def reserve(self):
+        """
+        Takes a token for one request
+        :return: Seconds to wait before sending it
+        """
+        with self._state():
+            now = time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens may go negative, which queues the callers one after the other
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            return max(wait, self.blocked_until - now)
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent
+        """
+        wait = self.reserve()
+        if wait > 0:
+            sleep(wait)
+
+    def on_success(self, headers):
+        """
+        Additive increase, up to the budget left in the current rate limit window
+        :param headers: Headers of the response
+        """
+        with self._state():
+            remaining = headers.get('x-rate-limit-remaining')
+            reset = headers.get('x-rate-limit-reset')
+            if remaining is not None and reset is not None:
+                window = max(int(reset) - time(), 1)
+                self.ceiling = max(int(remaining) / window, self.min_rate)
+            self.rate += self.increase
+            if self.ceiling is not None:
+                self.rate = min(self.rate, self.ceiling)
+
+    def on_throttle(self, headers):
+        """
+        Multiplicative decrease, and no more requests until the rate limit window resets
+        :param headers: Headers of the HTTP 429 response
+        """
+        with self._state():
+            now = time()
+            self.rate = max(self.rate * self.decrease, self.min_rate)
+            self.tokens = min(self.tokens, 0)
+            reset = headers.get('x-rate-limit-reset')
+            if reset is not None:
+                self.blocked_until = max(self.blocked_until, int(reset))
+            else:
+                self.blocked_until = max(self.blocked_until, now + 1 / self.rate)
+            logger.info("Rate limited, slowing down to %.2f requests/s until %s.", self.rate,
+                        datetime.utcfromtimestamp(self.blocked_until).strftime(DATE_FORMAT))
+
+
+class PageCache(object):
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_SIZE):
+        """
+        Keeps the raw JSON responses of search pages on disk, gzipped and keyed by URL, so they can be parsed
+        again offline. The least recently used pages are evicted once the cache grows past max_bytes.
+        :param directory: Directory of the cache
+        :param max_bytes: Maximum size of the cache on disk
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not path.isdir(directory):
+            os.makedirs(directory)
+        self.size = sum(path.getsize(page_path) for page_path in self._pages())
+
+    def _pages(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.json.gz'):
+                    yield path.join(root, name)
+
+    def page_path(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return path.join(self.directory, key[:2], key + '.json.gz')
+
+    def get(self, url):
+        """
+        :param url: URL of the page
+        :return: The cached JSON response, or None
+        """
+        page_path = self.page_path(url)
+        try:
+            with gzip.open(page_path, 'rb') as page_file:
+                entry = json.loads(page_file.read().decode('utf-8'))
+            # Mark the page as recently used
+            os.utime(page_path, None)
+        except (IOError, OSError, ValueError):
+            logger.debug("Cache miss: %s", url)
+            return None
+        return entry['response']
+
+    def put(self, url, response):
+        """
+        :param url: URL of the page
+        :param response: The JSON response of the page
+        """
+        page_path = self.page_path(url)
+        entry = {
+            'url': url,
+            'fetched_at': int(time()),
+            'response': response,
+        }
+        os.makedirs(path.dirname(page_path), exist_ok=True)
+        tmp_path = "%s.%i.%i.tmp" % (page_path, os.getpid(), threading.current_thread().ident)
+        with gzip.open(tmp_path, 'wb') as page_file:
+            page_file.write(json.dumps(entry).encode('utf-8'))
+        size = path.getsize(tmp_path)
+        old_size = path.getsize(page_path) if path.exists(page_path) else 0
+        os.replace(tmp_path, page_path)
+
+        with self.lock:
+            self.size += size - old_size
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used pages until the cache is 10% below its maximum size
+        """
+        pages = []
+        for page_path in self._pages():
+            try:
+                page_stat = os.stat(page_path)
+            except OSError:
+                continue
+            pages.append((page_stat.st_mtime, page_stat.st_size, page_path))
+        self.size = sum(page_size for _, page_size, _ in pages)
+        pages.sort()
+        for _, page_size, page_path in pages:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(page_path)
+                self.size -= page_size
+            except OSError:
+                pass
+
+
+# orjson is imported by _load_orjson on first use, and set to False if it is not installed
+orjson = None
+
+
+def _load_orjson():
+    global orjson
+    if orjson is None:
+        try:
+            import orjson as orjson_module
+        except ImportError:
+            orjson_module = False
+        orjson = orjson_module
+    return orjson
+
+
+def encode_items(items):
+    """
+    Serializes a batch of items to JSON lines, with orjson when it is installed
+    :param items: A list of Tweet or User records
+    :return: UTF-8 encoded bytes
+    """
+    if _load_orjson():
+        return b''.join([orjson.dumps(item_to_dict(item)) + b'\n' for item in items])
+    if six.PY2:
+        lines = [json.dumps(item_to_dict(item), ensure_ascii=False, encoding='utf-8') for item in items]
+    else:
+        lines = [json.dumps(item_to_dict(item), ensure_ascii=False) for item in items]
+    lines.append('')
+    return '\n'.join(lines).encode('utf-8')
+
+
+class JsonlWriter(object):
+    def __init__(self, filepath, compression=None, buffer_size=DEFAULT_BUFFER_SIZE, rotate_bytes=None,
+                 rotate_items=None, fsync=False, compresslevel=6):
+        """
+        Writes batches of items as JSON lines through a buffer, optionally compressed and split into parts.
+        Each flush writes the buffer as one gzip member or zstd frame, which concatenate into a valid file, so a
+        file can be truncated back to any flushed position and appended to.
+        :param filepath: Path of the output. Compression adds .gz or .zst, rotation numbers the parts.
+        :param compression: None, "gzip" or "zstd" (needs the package zstandard)
+        :param buffer_size: Bytes of serialized items buffered before they are written out
+        :param rotate_bytes: Start a new part once a part holds this many bytes
+        :param rotate_items: Start a new part once a part holds this many items
+        :param fsync: Sync the file to disk after each flush
+        :param compresslevel: Compression level
+        """
+        self.filepath = filepath
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.rotate_bytes = rotate_bytes
+        self.rotate_items = rotate_items
+        self.fsync = fsync
+        self.compresslevel = compresslevel
+        self.file = None
+        self.part = 0
+        self.part_items = 0
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.buffered_items = 0
+        if compression == "zstd":
+            import zstandard
+            self.compressor = zstandard.ZstdCompressor(level=compresslevel)
+        elif compression is not None and compression != "gzip":
+            raise ValueError("Unknown compression: %s" % compression)
+
+    def part_path(self, part):
+        """
+        :param part: Number of the part
+        :return: Path of the part
+        """
+        filepath = self.filepath
+        if self.rotate_bytes or self.rotate_items:
+            root, ext = path.splitext(filepath)
+            filepath = "%s.%05d%s" % (root, part, ext)
+        return filepath + COMPRESSION_SUFFIXES.get(self.compression, '')
+
+    def open(self, position=None):
+        """
+        Opens the output, replacing earlier files unless continuing from a position
+        :param position: A position returned by flush(), to continue writing from
+        :return: False if the files on disk do not reach that position
+        """
+        if position is not None:
+            part_path = self.part_path(position['part'])
+            # A part is only created once something is written to it, so the start of a new one may not exist yet
+            size = path.getsize(part_path) if path.exists(part_path) else 0
+            if size < position['offset']:
+                return False
+            self.part = position['part']
+            self.part_items = position['part_items']
+            self._remove_parts(self.part + 1)
+            if path.exists(part_path):
+                os.truncate(part_path, position['offset'])
+                self.file = io.open(part_path, 'ab')
+            else:
+                self.file = None
+        else:
+            self.part = 0
+            self.part_items = 0
+            self._remove_parts(1)
+            self.file = io.open(self.part_path(0), 'wb')
+        return True
+
+    def _remove_parts(self, part):
+        while path.exists(self.part_path(part)) and self.part_path(part) != self.part_path(0):
+            os.remove(self.part_path(part))
+            part += 1
+
+    def end_position(self):
+        """
+        :return: The position at the end of the files on disk, to append to them, or None if there are none
+        """
+        part = 0
+        while path.exists(self.part_path(part + 1)) and self.part_path(part + 1) != self.part_path(part):
+            part += 1
+        part_path = self.part_path(part)
+        if not path.exists(part_path):
+            return None
+        part_items = 0
+        if self.rotate_items:
+            if self.compression == "gzip":
+                part_file = gzip.open(part_path, 'rb')
+            elif self.compression == "zstd":
+                import zstandard
+                part_file = zstandard.ZstdDecompressor().stream_reader(io.open(part_path, 'rb'),
+                                                                       read_across_frames=True)
+            else:
+                part_file = io.open(part_path, 'rb')
+            with part_file:
+                part_items = sum(chunk.count(b'\n') for chunk in iter(lambda: part_file.read(1024 ** 2), b''))
+        return {'part': part, 'offset': path.getsize(part_path), 'part_items': part_items}
+
+    def write(self, items):
+        """
+        Buffers a batch of items
+        :param items: A list of items
+        """
+        if not items:
+            return
+        data = encode_items(items)
+        self.buffer.append(data)
+        self.buffered_bytes += len(data)
+        self.buffered_items += len(items)
+
+    def flush(self, force=False):
+        """
+        Writes the buffer out once it is full
+        :param force: Write it out even if it is not full
+        :return: The position after the written items, or None if they are still buffered
+        """
+        if not force and self.buffered_bytes < self.buffer_size:
+            return None
+
+        if self.buffer:
+            data = b''.join(self.buffer)
+            if self.compression == "gzip":
+                data = gzip.compress(data, compresslevel=self.compresslevel)
+            elif self.compression == "zstd":
+                data = self.compressor.compress(data)
+            if self.file is None:
+                self.file = io.open(self.part_path(self.part), 'wb')
+            self.file.write(data)
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.part_items += self.buffered_items
+            self.buffer = []
+            self.buffered_bytes = 0
+            self.buffered_items = 0
+
+        offset = self.file.tell() if self.file is not None else 0
+        if (self.rotate_bytes and offset >= self.rotate_bytes) or \
+                (self.rotate_items and self.part_items >= self.rotate_items):
+            # The next part is opened by the next write, so closing the output leaves no empty part behind
+            self.file.close()
+            self.file = None
+            self.part += 1
+            self.part_items = 0
+            offset = 0
+
+        return {'part': self.part, 'offset': offset, 'part_items': self.part_items}
+
+    def close(self):
+        self.flush(force=True)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class ParquetWriter(object):
+    def __init__(self, filepath, compression="snappy", row_group_pages=DEFAULT_ROW_GROUP_PAGES, rotate_items=None):
+        """
+        Writes items as typed Parquet columns, so reading a few columns does not touch the text. Ids and counts are
+        int64, epoch is a timestamp, and hashtags, urls, photos and videos are list columns. Requires pyarrow.
+        Rows are buffered and written as one row group every row_group_pages pages. A Parquet file is only readable
+        once it is closed, so checkpoints can only resume at the start of a part: enable rotate_items to resume
+        long searches. Without it, an interrupted search starts over.
+        :param filepath: Path of the output. A .jsonl extension is replaced by .parquet, rotation numbers the parts.
+        :param compression: Parquet compression codec, e.g. "snappy", "gzip" or "zstd"
+        :param row_group_pages: Number of pages in a row group
+        :param rotate_items: Start a new part once a part holds this many items
+        """
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.filepath = filepath
+        self.compression = compression
+        self.row_group_pages = row_group_pages
+        self.rotate_items = rotate_items
+        self.file = None
+        self.schema = None
+        self.part = 0
+        self.part_items = 0
+        self.rows = []
+        self.pages = 0
+
+    def part_path(self, part):
+        """
+        :param part: Number of the part
+        :return: Path of the part
+        """
+        root, ext = path.splitext(self.filepath)
+        if ext in ('.jsonl', '.json', ''):
+            ext = '.parquet'
+        if self.rotate_items:
+            return "%s.%05d%s" % (root, part, ext)
+        return root + ext
+
+    def tweet_schema(self):
+        pa = self.pa
+        return pa.schema([
+            ('id', pa.int64()),
+            ('epoch', pa.timestamp('s', tz='UTC')),
+            ('text', pa.string()),
+            ('reply_count', pa.int64()),
+            ('retweet_count', pa.int64()),
+            ('favorite_count', pa.int64()),
+            ('hashtags', pa.list_(pa.string())),
+            ('urls', pa.list_(pa.string())),
+            ('photos', pa.list_(pa.string())),
+            ('videos', pa.list_(pa.string())),
+            ('cards', pa.list_(pa.struct([('card_url', pa.string()), ('expanded_url', pa.string())]))),
+            ('user_id', pa.int64()),
+            ('user_screen_name', pa.string()),
+            ('user_name', pa.string()),
+        ])
+
+    def user_schema(self):
+        pa = self.pa
+        return pa.schema([
+            ('id', pa.int64()),
+            ('screen_name', pa.string()),
+            ('name', pa.string()),
+            ('bio', pa.string()),
+            ('verified', pa.bool_()),
+        ])
+
+    @staticmethod
+    def tweet_row(tweet):
+        return {
+            'id': tweet.id,
+            'epoch': tweet.epoch,
+            'text': tweet.text,
+            'reply_count': tweet.reply_count,
+            'retweet_count': tweet.retweet_count,
+            'favorite_count': tweet.favorite_count,
+            'hashtags': tweet.hashtags,
+            'urls': tweet.urls,
+            'photos': tweet.photos,
+            'videos': [video['expanded_url'] for video in tweet.videos],
+            'cards': tweet.cards,
+            'user_id': tweet.user.id,
+            'user_screen_name': tweet.user.screen_name,
+            'user_name': tweet.user.name,
+        }
+
+    @staticmethod
+    def user_row(user):
+        return {
+            'id': user.id,
+            'screen_name': user.screen_name,
+            'name': user.name,
+            'bio': user.bio,
+            'verified': user.verified,
+        }
+
+    def open(self, position=None):
+        """
+        Prepares the output, removing the parts at and after position
+        :param position: A position returned by flush(), to continue writing from
+        :return: False if position is after the only file of an output that is not rotated, which cannot be resumed
+        """
+        if position is not None and position['part'] > 0 and not self.rotate_items:
+            return False
+        self.part = position['part'] if position is not None else 0
+        self.part_items = 0
+        part = self.part
+        while path.exists(self.part_path(part)):
+            os.remove(self.part_path(part))
+            part += 1
+            if not self.rotate_items:
+                break
+        return True
+
+    def end_position(self):
+        """
+        :return: The position after the parts on disk, to add parts after them, or None if there are none
+        """
+        if not path.exists(self.part_path(0)):
+            return None
+        if not self.rotate_items:
+            raise ValueError("A Parquet file cannot be appended to, rotate it to add to it: %s" % self.part_path(0))
+        part = 0
+        while path.exists(self.part_path(part)):
+            part += 1
+        return {'part': part, 'offset': 0, 'part_items': 0}
+
+    def write(self, items):
+        """
+        Buffers a page of items
+        :param items: A list of Tweet or User records
+        """
+        if not items:
+            return
+        is_tweet = isinstance(items[0], Tweet)
+        if self.schema is None:
+            self.schema = self.tweet_schema() if is_tweet else self.user_schema()
+        row = self.tweet_row if is_tweet else self.user_row
+        self.rows.extend(row(item) for item in items)
+        self.pages += 1
+
+    def flush(self, force=False):
+        """
+        Writes a row group once enough pages are buffered, and closes the part when it is full
+        :param force: Write out everything and close the part
+        :return: The position of the next part once the current one is closed, otherwise None. Without rotation
+                 there is no next part, so always None.
+        """
+        if self.rows and (force or self.pages >= self.row_group_pages):
+            if self.file is None:
+                self.file = self.pq.ParquetWriter(self.part_path(self.part), self.schema,
+                                                  compression=self.compression)
+            self.file.write_table(self.pa.Table.from_pylist(self.rows, schema=self.schema))
+            self.part_items += len(self.rows)
+            self.rows = []
+            self.pages = 0
+
+        if force or (self.rotate_items and self.part_items >= self.rotate_items):
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                self.part += 1
+                self.part_items = 0
+            # A single file would be replaced by anything written after it
+            if self.rotate_items:
+                return {'part': self.part, 'offset': 0, 'part_items': 0}
+        return None
+
+    def close(self):
+        self.flush(force=True)
+
+
+class CheckpointStore(object):
+    def __init__(self, filepath):
+        """
+        Keeps the progress of the search writing to filepath in a file next to it
+        :param filepath: Path of the output file
+        """
+        self.path = filepath + CHECKPOINT_SUFFIX
+
+    def load(self):
+        """
+        :return: The last saved checkpoint, or None
+        """
+        try:
+            with io.open(self.path, 'r', encoding='utf-8') as checkpoint_file:
+                return json.load(checkpoint_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, query, max_position, counter, position, done=False, newest=None, start=None, oldest=None):
+        """
+        Atomically replaces the checkpoint
+        :param query: The query of the search
+        :param max_position: Cursor of the next page to fetch
+        :param counter: Number of items saved so far
+        :param position: Where the output ends once those items are written, as returned by the writer
+        :param done: True when the search is complete
+        :param newest: The newest item saved so far by an incremental search, see HighWaterMarks
+        :param start: Where the output ended when an incremental search started appending to it
+        :param oldest: The id of the oldest item saved so far by an incremental search
+        """
+        checkpoint = {
+            'query': query,
+            'max_position': max_position,
+            'counter': counter,
+            'position': position,
+            'done': done,
+            'newest': newest,
+            'start': start,
+            'oldest': oldest,
+        }
+        tmp_path = self.path + '.tmp'
+        with io.open(tmp_path, 'w', encoding='utf-8') as checkpoint_file:
+            checkpoint_file.write(six.text_type(json.dumps(checkpoint)))
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if path.exists(self.path):
+            os.remove(self.path)
+
+
+class HighWaterMarks(object):
+    def __init__(self, filepath):
+        """
+        The newest tweet collected by each query, so the next run of an incremental search stops as soon as it
+        reaches tweets it already has. Queries that only differ by since: and until: share a mark. The marks are kept
+        in one JSON file, which searches of other threads and processes can update at the same time.
+        :param filepath: Path of the file
+        """
+        self.path = filepath
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(query):
+        return ' '.join(term for term in query.split()
+                        if not term.startswith(('since:', 'until:', 'since_time:', 'until_time:')))
+
+    def load(self):
+        try:
+            with io.open(self.path, 'r', encoding='utf-8') as marks_file:
+                return json.load(marks_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, query):
+        """
+        :param query: The query of the search
+        :return: The mark of the query, a dictionary with the id and epoch of its newest tweet, or None
+        """
+        with self.lock:
+            return self.load().get(self.key(query))
+
+    def update(self, query, newest):
+        """
+        Raises the mark of a query
+        :param query: The query of the search
+        :param newest: A dictionary with the id and epoch of the newest tweet the search collected
+        """
+        with self.lock:
+            lock_file = io.open(self.path + '.lock', 'a') if fcntl is not None else None
+            try:
+                if lock_file is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                marks = self.load()
+                key = self.key(query)
+                if key in marks and marks[key]['id'] >= newest['id']:
+                    return
+                marks[key] = dict(newest, updated_at=int(time()))
+                tmp_path = "%s.%i.tmp" % (self.path, os.getpid())
+                with io.open(tmp_path, 'w', encoding='utf-8') as marks_file:
+                    marks_file.write(six.text_type(json.dumps(marks)))
+                os.replace(tmp_path, self.path)
+            finally:
+                if lock_file is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                    lock_file.close()
+
+
+class SeenIndex(object):
+    def __init__(self, directory, buffer_size=SEEN_INDEX_BUFFER):
+        """
+        Persistent set of item ids, shared by the searches and runs writing to the same output directory.
+        Ids are stored as sorted int64 segment files that are memory-mapped and binary searched, so lookups keep
+        working at hundreds of millions of ids while only the newest buffer_size ids are held in memory.
+        Segments are merged whenever the newest one has grown to half the size of the one before, which keeps their
+        number logarithmic in the number of ids.
+        :param directory: Directory of the segment files
+        :param buffer_size: Number of new ids buffered in memory before they are written out
+        """
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        # Held while segments are written and merged, which is done without holding lock so lookups go on
+        self.merge_lock = threading.Lock()
+        # Ids added by each search and not committed yet, and committed ids not written out yet
+        self.pending = {}
+        self.committed = set()
+        self.flushing = frozenset()
+        self.segments = []
+        if not path.isdir(directory):
+            os.makedirs(directory)
+        self.refresh()
+
+    def refresh(self):
+        """
+        Maps the segments written by other runs since we last looked
+        """
+        known = set(segment_path for segment_path, _, _ in self.segments)
+        for name in sorted(os.listdir(self.directory)):
+            segment_path = path.join(self.directory, name)
+            if name.endswith('.ids') and segment_path not in known:
+                self._map(segment_path)
+
+    def _map(self, segment_path):
+        try:
+            with io.open(segment_path, 'rb') as segment_file:
+                segment = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            # Empty, or merged away by another run
+            return
+        self.segments.append((segment_path, segment, memoryview(segment).cast('q')))
+
+    def _write_segment(self, ids):
+        segment_path = path.join(self.directory, "%020d-%d.ids" % (int(time() * 1e6), os.getpid()))
+        tmp_path = segment_path + '.tmp'
+        chunk = array('q')
+        with io.open(tmp_path, 'wb') as segment_file:
+            for item_id in ids:
+                chunk.append(item_id)
+                if len(chunk) >= 65536:
+                    chunk.tofile(segment_file)
+                    del chunk[:]
+            chunk.tofile(segment_file)
+        os.replace(tmp_path, segment_path)
+        return segment_path
+
+    def __contains__(self, item_id):
+        with self.lock:
+            return self._contains(item_id)
+
+    def _contains(self, item_id):
+        if item_id in self.committed or item_id in self.flushing:
+            return True
+        if any(item_id in ids for ids in self.pending.values()):
+            return True
+        for _, _, ids in self.segments:
+            i = bisect.bisect_left(ids, item_id)
+            if i < len(ids) and ids[i] == item_id:
+                return True
+        return False
+
+    def add(self, item_id, owner=None):
+        """
+        :param item_id: An item id
+        :param owner: The search adding it, whose ids are committed or discarded together
+        :return: True if the id was not seen before
+        """
+        item_id = int(item_id)
+        with self.lock:
+            if self._contains(item_id):
+                return False
+            self.pending.setdefault(owner, set()).add(item_id)
+            return True
+
+    def commit(self, owner=None):
+        """
+        Called at batch boundaries, after the output of the owner is safely written. Only the ids of that search are
+        committed, other searches sharing the index commit theirs once their own output is written. Writes the
+        committed ids out once the buffer is full.
+        :param owner: The search whose ids are committed
+        """
+        with self.lock:
+            self.committed.update(self.pending.pop(owner, ()))
+            full = len(self.committed) >= self.buffer_size
+        if full:
+            self.flush()
+
+    def discard(self, owner=None):
+        """
+        Forgets the ids the owner added since it last committed, as its output does not have those items
+        :param owner: The search whose ids are discarded
+        """
+        with self.lock:
+            self.pending.pop(owner, None)
+
+    def flush(self):
+        """
+        Writes the committed ids out as a new segment and merges segments of similar size. Lookups and adds by other
+        searches go on meanwhile: the ids stay where they are until the segment that replaces them is mapped.
+        """
+        with self.merge_lock:
+            with self.lock:
+                committed = self.committed
+                self.committed = set()
+                # Still found while the segment is written
+                self.flushing = committed
+            if not committed:
+                return
+            segment_path = self._write_segment(sorted(committed))
+            with self.lock:
+                self._map(segment_path)
+                self.flushing = frozenset()
+            while True:
+                with self.lock:
+                    if len(self.segments) < 2 or len(self.segments[-1][2]) * 2 < len(self.segments[-2][2]):
+                        break
+                    older, newer = self.segments[-2:]
+                self._merge(older, newer)
+            with self.lock:
+                self.refresh()
+
+    def _merge(self, older, newer):
+        """
+        Replaces two segments by one. Only flush() adds or removes segments, so they are still the last two once the
+        merged one is written.
+        """
+        def unique(ids):
+            last_id = None
+            for item_id in ids:
+                if item_id != last_id:
+                    last_id = item_id
+                    yield item_id
+
+        merged_path = self._write_segment(unique(heapq.merge(older[2], newer[2])))
+        with self.lock:
+            del self.segments[-2:]
+            self._map(merged_path)
+        for segment_path, segment, ids in (older, newer):
+            ids.release()
+            segment.close()
+            try:
+                os.remove(segment_path)
+            except OSError:
+                pass
+
+    def close(self):
+        self.flush()
+        with self.merge_lock, self.lock:
+            for _, segment, ids in self.segments:
+                ids.release()
+                segment.close()
+            self.segments = []
+
 
 class TwitterSearchImpl(TwitterSearch):
-    def __init__(self, session, rate_delay, error_delay, max_items, filepath, useragent_cache_path=fake_useragent_settings.DB):
+    # Whether a search that gave up on a request can be continued with resume
+    resumable = True
+
+    def __init__(self, session, rate_delay, error_delay, max_items, filepath, useragent_cache_path=None, resume=False,
+                 seen_index=None, sink=JsonlWriter, high_water_marks=None, **kwargs):
         """
         :param rate_delay: How long to pause between calls to Twitter
         :param error_delay: How long to pause when an error occurs
         :param max_items: Maximum number of items to collect for this example
+        :param useragent_cache_path: Path of the fake_useragent database, by default the one of fake_useragent
+        :param resume: Continue from the last checkpoint of filepath, if there is one for the same query
+        :param seen_index: A SeenIndex. Items it has already seen are not written again.
+        :param sink: Called with filepath to create the writer of the output, JsonlWriter by default
+        :param high_water_marks: HighWaterMarks to search incrementally. Only tweets newer than the ones collected by
+                                 the last complete run of the query are searched, and appended to the output.
+        :param kwargs: Options passed on to TwitterSearch
         """
-        super(TwitterSearchImpl, self).__init__(session, rate_delay, error_delay, useragent_cache_path)
+        super(TwitterSearchImpl, self).__init__(session, rate_delay, error_delay,
+                                                useragent_cache_path=useragent_cache_path, **kwargs)
+        self.seen_index = seen_index
         self.max_items = max_items
         self.counter = 0
         self.filepath = filepath
-        self.jsonl_file = None
+        self.writer = sink(filepath)
+        self.resume = resume
+        self.checkpoints = CheckpointStore(filepath)
+        self.query = None
+        self.max_position = None
+        self.high_water_marks = high_water_marks
+        # The mark of the last complete run, the newest item of this one and the id of its oldest
+        self.mark = None
+        self.newest = None
+        self.oldest = None
+        # Whether this run got down to the mark, or stopped at max_items
+        self.reached_mark = False
+        self.limited = False
+        # The cursor of the page saved last
+        self.page_position = None
+        self.closing = False
+        # Where this incremental run started appending to the output
+        self.start = None
+        # Pages saved while their users are looked up, in order
+        self.enriching = False
+        self.waiting_pages = deque()
 
     def search(self, query, target_type, **kwargs):
-        # Specify a user agent to prevent Twitter from returning a profile card
-        headers = {
-            'Accept': 'application/json, text/javascript, */*; q=0.01',
-            'Referer': 'https://twitter.com/search',
-            'User-Agent': self.UA.random,
-            'X-Twitter-Active-User': 'yes',
-            'X-Requested-With': 'XMLHttpRequest'
-        }
-        self.session.headers.update(headers)
+        if not self.open_output(query):
+            return
+        completed = False
+        try:
+            super(TwitterSearchImpl, self).search(query, target_type=target_type, max_position=self.max_position,
+                                                  **kwargs)
+            completed = not self.cancelled() and not self.failed
+        finally:
+            self.close_output(completed)
+
+    def open_output(self, query):
+        """
+        Opens the output file. When resuming, drops whatever was written after the last checkpoint and sets
+        max_position and counter to continue from it.
+        :param query: The query of the search
+        :return: False if the checkpoint says the search is already complete
+        """
+        self.query = query
+        if self.high_water_marks is not None:
+            self.mark = self.high_water_marks.get(query)
+        # Incremental and deduplicated searches append to the output, so they always continue an interrupted run
+        appending = self.high_water_marks is not None or self.seen_index is not None
+        checkpoint = self.checkpoints.load() if self.resume or appending else None
+        if checkpoint is not None and checkpoint['query'] != query:
+            if (self.high_water_marks is not None and
+                    HighWaterMarks.key(checkpoint['query']) == HighWaterMarks.key(query)):
+                # An incremental run with another date range. If it was interrupted, run again from where it started.
+                if checkpoint['done'] or checkpoint.get('start') is None:
+                    checkpoint = None
+                else:
+                    checkpoint = dict(checkpoint, counter=0, max_position=None, newest=None, oldest=None,
+                                      position=checkpoint['start'])
+            elif appending and checkpoint['done']:
+                # The output of a complete search of another query, which this one adds to
+                checkpoint = None
+            else:
+                logger.warning("%s : Checkpoint is for another query, starting over.", self.filepath)
+                checkpoint = None
+        if checkpoint is not None and checkpoint['done']:
+            if self.high_water_marks is None and self.resume:
+                logger.info("%s : Search already complete.", self.filepath)
+                return False
+            # The last run is complete, so this is a new one
+            checkpoint = None
+        if checkpoint is not None and not self.writer.open(checkpoint['position']):
+            logger.warning("%s : Output cannot be resumed from its checkpoint, starting over.", self.filepath)
+            checkpoint = None
+
+        if checkpoint is None:
+            # The items already in the output are in the seen index, so they are kept instead of overwritten
+            if self.mark is not None or self.seen_index is not None:
+                position = self.writer.end_position()
+                if position is not None and self.writer.open(position):
+                    # Record where this run starts, so an interrupted run is cut back to it
+                    self.start = position
+                    self.checkpoints.save(query, None, 0, position, start=position)
+                    if self.mark is not None:
+                        logger.info("%s : Searching tweets newer than %s.", self.filepath, self.mark['id'])
+                    else:
+                        logger.info("%s : Appending new items.", self.filepath)
+                    return True
+            self.writer.open()
+            return True
+
+        # The max_items of an incremental run counts the items of that run only
+        self.counter = checkpoint['counter'] if self.high_water_marks is None else 0
+        self.max_position = checkpoint['max_position']
+        self.newest = checkpoint.get('newest')
+        self.oldest = checkpoint.get('oldest')
+        self.start = checkpoint.get('start')
+        logger.info("%s : Resuming after %i items.", self.filepath, checkpoint['counter'])
+        return True
 
-        self.jsonl_file = io.open(self.filepath, 'w', encoding='utf-8')
-        super(TwitterSearchImpl, self).search(query, target_type=target_type, **kwargs)
-        self.jsonl_file.close()
+    def close_output(self, completed):
+        """
+        Closes the output file
+        :param completed: True if the search ran to the end, so resuming should not search again
+        """
+        if self.failed and self.resumable:
+            logger.error("%s : Gave up on a request, the search is incomplete. Resume it to continue.",
+                         self.filepath)
+        self.closing = True
+        if completed and self.high_water_marks is not None and self.limited and not self.reached_mark:
+            # The tweets between the oldest one saved and the mark are still missing. The next run searches the last
+            # page again, skipping the tweets saved already, and carries on down to the mark.
+            logger.info("%s : Stopped at the limit, the next run continues from here.", self.filepath)
+            self.checkpoint(self.page_position)
+        elif completed:
+            self.checkpoint(None, done=True)
+            if self.seen_index is not None:
+                self.seen_index.flush()
+            # Only a run that got down to the mark, or to the end of the results, has every tweet up to its newest one
+            if self.high_water_marks is not None and self.newest is not None:
+                self.high_water_marks.update(self.query, self.newest)
+        elif self.cancelled() or self.failed:
+            # Cancelled and failed searches stop between pages, so everything saved so far is kept
+            self.checkpoint(self.max_position)
+        if self.seen_index is not None:
+            self.seen_index.discard(owner=self)
+        self.writer.close()
+
+    def checkpoint(self, max_position, done=False):
+        self.page_position = self.max_position
+        self.max_position = max_position
+        # A cancelled or failed search stops after this page, so everything saved so far is flushed and kept
+        force = done or self.closing or self.cancelled() or self.failed
+        if self.waiting_pages:
+            self.write_enriched_pages(block=force)
+            # The writer's position does not cover pages still waiting for their users
+            if self.waiting_pages:
+                return
+        # Items still in the writer's buffer are fetched again on resume, so only flushed positions are recorded
+        position = self.writer.flush(force=force)
+        # A complete search is not resumed, so it is recorded even when the writer has no position to resume from
+        if position is None and not done:
+            return
+        self.checkpoints.save(self.query, max_position, self.counter, position, done=done, newest=self.newest,
+                              start=self.start, oldest=self.oldest)
+        # Ids only reach the index once their items are committed, so a resumed search does not skip them
+        if self.seen_index is not None:
+            self.seen_index.commit(owner=self)
 
     def save_items(self, items):
         """
         Just prints out items
         :return:
         """
+        batch = []
+        continue_search = True
         for item in items:
-            # Lets add a counter so we only collect a max number of items
-            self.counter += 1
+            # Tweets up to the mark were collected by an earlier run, so the search stops after this page
+            if self.mark is not None and item.id <= self.mark['id']:
+                self.reached_mark = True
+                continue_search = False
+                continue
+            # A run that stopped at max_items is continued from its last page, which was partly saved
+            if self.oldest is not None and item.id >= self.oldest:
+                continue
 
-            if six.PY2:
-                data = json.dumps(item, ensure_ascii=False, encoding='utf-8')
-            else:
-                data = json.dumps(item, ensure_ascii=False)
+            # Skip items that were already written by this or an earlier search
+            if self.seen_index is not None and not self.seen_index.add(item.id, owner=self):
+                continue
+
+            if self.high_water_marks is not None:
+                if self.newest is None or item.id > self.newest['id']:
+                    self.newest = {'id': item.id, 'epoch': item.epoch}
+                self.oldest = item.id
 
-            self.jsonl_file.write(data + '\n')
+            # Lets add a counter so we only collect a max number of items
+            self.counter += 1
+            batch.append(item)
 
             if self.counter % PROGRESS_PER == 0:
                 logger.info("%s : %i items saved to file.", self.filepath, self.counter)
 
             # When we've reached our max limit, return False so collection stops
             if self.max_items is not None and self.counter >= self.max_items:
-                return False
+                self.limited = True
+                continue_search = False
+                break
 
-        return True
+        self.write_page(batch)
+        return continue_search
 
+    def retrieve_user_details(self, items):
+        """
+        Starts looking up the users without waiting for them. save_items() holds the page until its users are
+        looked up, so the users of several pages are looked up in full batches while the search goes on.
+        :param items: A list of User records
+        :return: The same list
+        """
+        if self.enricher is None:
+            self.enricher = UserEnricher()
+        self.enricher.submit(items)
+        self.enriching = True
+        return items
 
-def twitter_search(search_terms=None, since=None, until=None, language=None, accounts=None, search_filter=None,
-                   target_type=DEFAULT_TARGET_TYPE,
-                   rate_delay=DEFAULT_RATE_DELAY, error_delay=DEFAULT_ERROR_DELAY, user_stats=False,
-                   limit=DEFAULT_LIMIT,
-                   output_dir=".", output_file=None, useragent_cache_path=fake_useragent_settings.DB):
-    session = requests.Session()
+    def write_page(self, items):
+        """
+        Writes a page of items, once their users are looked up when enriching
+        :param items: A list of items
+        """
+        if not self.enriching:
+            self.writer.write(items)
+            return
+        self.waiting_pages.append(items)
+        if len(self.waiting_pages) > MAX_WAITING_PAGES:
+            self.enricher.wait(self.waiting_pages[0])
+        self.write_enriched_pages()
+
+    def write_enriched_pages(self, block=False):
+        """
+        Writes the waiting pages whose users are looked up, in order
+        :param block: Wait for the lookups of every waiting page
+        """
+        while self.waiting_pages:
+            if block:
+                self.enricher.wait(self.waiting_pages[0])
+            elif not self.enricher.ready(self.waiting_pages[0]):
+                break
+            self.writer.write(self.enricher.apply(self.waiting_pages.popleft()))
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        """
+        Counts observations by bucket, like a Prometheus histogram
+        :param buckets: Upper bounds of the buckets, sorted
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """
+        :return: (upper bound, number of observations up to it) pairs, ending with +Inf
+        """
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
 
+
+class Metrics(object):
+    def __init__(self):
+        """
+        Collects metrics of searches: request latency, bytes downloaded, parse and save time, items per page,
+        retries and queue depths. Searches only record metrics when they are given a Metrics, so there is no cost
+        otherwise. One Metrics can be shared by many searches and threads.
+        """
+        self.lock = threading.Lock()
+        self.histograms = {
+            'request_seconds': Histogram(LATENCY_BUCKETS),
+            'parse_seconds': Histogram(DURATION_BUCKETS),
+            'save_seconds': Histogram(DURATION_BUCKETS),
+            'page_items': Histogram(PAGE_ITEMS_BUCKETS),
+        }
+        # Counters and gauges by name, then by (label name, label value), or None when unlabelled
+        self.counters = {}
+        self.gauges = {}
+
+    def _inc(self, name, value=1, label=None):
+        values = self.counters.setdefault(name, {})
+        values[label] = values.get(label, 0) + value
+
+    def observe_request(self, seconds, status, size):
+        """
+        :param seconds: Time the request took
+        :param status: HTTP status code, or the kind of failure, e.g. "timeout"
+        :param size: Bytes downloaded
+        """
+        with self.lock:
+            self.histograms['request_seconds'].observe(seconds)
+            self._inc('requests_total', label=('status', str(status)))
+            self._inc('response_bytes_total', size)
+
+    def observe_parse(self, seconds, items):
+        """
+        :param seconds: Time parsing a page took
+        :param items: Number of items on the page
+        """
+        with self.lock:
+            self.histograms['parse_seconds'].observe(seconds)
+            self.histograms['page_items'].observe(items)
+
+    def observe_save(self, seconds, items):
+        """
+        :param seconds: Time saving a page took
+        :param items: Number of items on the page
+        """
+        with self.lock:
+            self.histograms['save_seconds'].observe(seconds)
+            self._inc('pages_total')
+            self._inc('items_total', items)
+
+    def on_retry(self, event):
+        """
+        Counts retries and give ups. Listens to RetryEngine events.
+        :param event: A RetryEvent
+        """
+        with self.lock:
+            name = 'retries_total' if event.action == "retry" else 'give_ups_total'
+            self._inc(name, label=('kind', str(event.kind)))
+
+    def set_queue_depth(self, queue_name, depth):
+        """
+        :param queue_name: Name of the queue, e.g. "pipeline"
+        :param depth: Number of entries waiting in the queue
+        """
+        with self.lock:
+            self.gauges.setdefault('queue_depth', {})[('queue', queue_name)] = depth
+
+    def snapshot(self):
+        """
+        :return: The metrics as a dictionary that can be serialized to JSON
+        """
+        def values(metrics):
+            return dict((name, dict(('%s=%s' % label if label else '', value) for label, value in by_label.items()))
+                        for name, by_label in metrics.items())
+
+        with self.lock:
+            histograms = {}
+            for name, histogram in self.histograms.items():
+                histograms[name] = {
+                    'buckets': [['+Inf' if bound == float('inf') else bound, count]
+                                for bound, count in histogram.cumulative_counts()],
+                    'sum': histogram.sum,
+                    'count': histogram.count,
+                }
+            return {
+                'time': time(),
+                'histograms': histograms,
+                'counters': values(self.counters),
+                'gauges': values(self.gauges),
+            }
+
+    def prometheus(self):
+        """
+        :return: The metrics in the Prometheus text exposition format
+        """
+        def sample(name, label, value):
+            if label is None:
+                return "%s%s %s" % (METRICS_PREFIX, name, value)
+            return '%s%s{%s="%s"} %s' % (METRICS_PREFIX, name, label[0], label[1], value)
+
+        lines = []
+        with self.lock:
+            for name, histogram in sorted(self.histograms.items()):
+                lines.append("# TYPE %s%s histogram" % (METRICS_PREFIX, name))
+                for bound, count in histogram.cumulative_counts():
+                    le = "+Inf" if bound == float('inf') else repr(float(bound))
+                    lines.append(sample(name + "_bucket", ('le', le), count))
+                lines.append(sample(name + "_sum", None, histogram.sum))
+                lines.append(sample(name + "_count", None, histogram.count))
+            for metric_type, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                for name, by_label in sorted(metrics.items()):
+                    lines.append("# TYPE %s%s %s" % (METRICS_PREFIX, name, metric_type))
+                    for label, value in sorted(by_label.items(), key=lambda item: item[0] or ()):
+                        lines.append(sample(name, label, value))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class PrometheusExporter(object):
+    def __init__(self, metrics, port, host=''):
+        """
+        Serves the metrics over HTTP for Prometheus to scrape, from a background thread
+        :param metrics: The Metrics to serve
+        :param port: Port to listen on
+        :param host: Address to listen on, all by default
+        """
+        self.metrics = metrics
+        self.port = port
+        self.host = host
+        self.server = None
+
+    def start(self):
+        from six.moves import BaseHTTPServer
+        metrics = self.metrics
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("Metrics : " + format, *args)
+
+        self.server = BaseHTTPServer.HTTPServer((self.host, self.port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever, name="metrics-exporter")
+        thread.daemon = True
+        thread.start()
+        logger.info("Serving metrics on port %i", self.server.server_address[1])
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class JsonMetricsExporter(object):
+    def __init__(self, metrics, filepath, interval=DEFAULT_METRICS_INTERVAL):
+        """
+        Periodically writes a JSON snapshot of the metrics to a file, from a background thread
+        :param metrics: The Metrics to write
+        :param filepath: Path of the file, replaced with every snapshot
+        :param interval: Seconds between snapshots
+        """
+        self.metrics = metrics
+        self.filepath = filepath
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def dump(self):
+        tmp_path = "%s.%i.tmp" % (self.filepath, os.getpid())
+        with io.open(tmp_path, 'w', encoding='utf-8') as metrics_file:
+            metrics_file.write(six.text_type(json.dumps(self.metrics.snapshot())))
+        os.replace(tmp_path, self.filepath)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.dump()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="metrics-exporter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the exporter and writes a final snapshot
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.dump()
+
+
+def timed_call(fn, *args):
+    """
+    :return: The result of fn(*args), and the seconds it took
+    """
+    start = perf_counter()
+    result = fn(*args)
+    return result, perf_counter() - start
+
+
+class AsyncTwitterSearch(TwitterSearch):
+    __metaclass__ = ABCMeta
+
+    def __init__(self, session, rate_delay, error_delay=5, semaphore=None, **kwargs):
+        """
+        asyncio variant of TwitterSearch. Searches can share one aiohttp.ClientSession and one semaphore, which
+        bounds the number of requests in flight across all of them.
+        :param session: An aiohttp.ClientSession
+        :param rate_delay: How long to pause between calls to Twitter
+        :param error_delay: How long to pause when an error occurs
+        :param semaphore: An asyncio.Semaphore shared by concurrent searches
+        :param kwargs: Options passed on to TwitterSearch
+        """
+        super(AsyncTwitterSearch, self).__init__(session, rate_delay, error_delay, **kwargs)
+        self.semaphore = semaphore
+        # The session is shared, so headers are kept per search and sent with each request
+        self.headers = {}
+
+    async def search(self, query, target_type, **kwargs):
+        """
+        Scrape items from twitter
+        :param query:   Query to search Twitter with. Takes form of queries constructed with using Twitters
+                        advanced search: https://twitter.com/search-advanced
+        :param target_type:    Can be "tweets" or "users"
+        """
+        pages = self.iter_pages(query, target_type, **kwargs)
+        try:
+            async for page in pages:
+                continue_search = self.save_page(page.items)
+                self.checkpoint(page.max_position)
+                if not continue_search:
+                    break
+        finally:
+            await pages.aclose()
+
+    async def iter_pages(self, query, target_type, **kwargs):
+        """
+        asyncio variant of TwitterSearch.iter_pages(), an asynchronous generator of Pages
+        """
+        import asyncio
+        self.failed = False
+        if not self.offline:
+            self.headers.update(self.search_headers())
+
+        min_item = kwargs.get('max_position')
+        url = self.construct_url(query, target_type=target_type, max_position=min_item,
+                                 language=kwargs.get('language'))
+        loop = asyncio.get_event_loop()
+
+        # Initialize search function wrapper according to the target type
+        parse_tweets_fn = self.item_parser(target_type)
+
+        response = await self.execute_search(url)
+        while response is not None and response['items_html'] is not None and not self.cancelled():
+            # Parsing is CPU bound, keep it off the event loop
+            items = await loop.run_in_executor(None, self.parse_page, parse_tweets_fn, response['items_html'])
+
+            # Check if we should collect additional user details
+            if target_type == "users" and kwargs.get("user_stats"):
+                await loop.run_in_executor(None, self.retrieve_user_details, items)
+
+            # If we have no items, then we can break the loop early
+            if len(items) == 0:
+                break
+
+            max_item = response["min_position"]
+            yield Page(items, max_item)
+
+            if max_item is None or max_item == min_item or self.cancelled():
+                break
+            url = self.construct_url(query, target_type=target_type, max_position=max_item,
+                                     language=kwargs.get('language'))
+            # Sleep for our rate_delay
+            await asyncio.sleep(self.rate_delay)
+            response = await self.execute_search(url)
+            min_item = max_item
+
+    async def iter_search(self, query, target_type=DEFAULT_TARGET_TYPE, **kwargs):
+        """
+        asyncio variant of TwitterSearch.iter_search(), an asynchronous generator of Tweet or User records.
+        Close it with aclose(), or contextlib.aclosing, when breaking out of it early.
+        """
+        pages = self.iter_pages(query, target_type, **kwargs)
+        try:
+            async for page in pages:
+                for item in page.items:
+                    yield item
+        finally:
+            await pages.aclose()
+
+    async def execute_search(self, url):
+        """
+        Executes a search to Twitter for the given URL
+        :param url: URL to search twitter with
+        :return: A JSON object with data from Twitter
+        """
+        if self.offline:
+            return self.cache.get(url)
+
+        import asyncio
+        import aiohttp
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(DEFAULT_CONCURRENCY)
+
+        retry = self.retry_engine.start(self, url)
+        while True:
+            status = headers = kind = None
+            if self.rate_limiter is not None:
+                await asyncio.sleep(self.rate_limiter.reserve())
+            try:
+                logger.debug("URL: %s", url)
+                async with self.semaphore:
+                    if self.metrics is not None:
+                        started = perf_counter()
+                    async with self.session.get(url, headers=self.headers,
+                                                timeout=aiohttp.ClientTimeout(total=DEFAULT_TIMEOUT)) as response:
+                        if self.metrics is not None:
+                            # The body is kept, so reading it here does not download it twice
+                            self.metrics.observe_request(perf_counter() - started, response.status,
+                                                         len(await response.read()))
+                        if response.status == 200:
+                            data = await response.json(content_type=None)
+                            if self.rate_limiter is not None:
+                                self.rate_limiter.on_success(response.headers)
+                            if self.cache is not None:
+                                self.cache.put(url, data)
+                            return data
+                        # 400 Bad Request
+                        elif response.status == 400:
+                            logger.debug("HTTP 400 - Bad request")
+                            return await response.json(content_type=None)
+                        status = response.status
+                        headers = response.headers
+            except asyncio.TimeoutError:
+                kind = "timeout"
+            except aiohttp.ClientConnectionError:
+                kind = "connection"
+            if kind is not None and self.metrics is not None:
+                self.metrics.observe_request(perf_counter() - started, kind, 0)
+
+            if status == 429 and self.rate_limiter is not None:
+                self.rate_limiter.on_throttle(headers)
+                headers = None
+
+            # The semaphore is released while we wait, so other searches keep going
+            delay = retry.next_delay(status=status, kind=kind, headers=headers)
+            if delay is None:
+                self.failed = True
+                return None
+            await asyncio.sleep(delay)
+
+    def rotate_user_agent(self):
+        self.headers['User-Agent'] = self.UA.random
+
+
+class AsyncTwitterSearchImpl(AsyncTwitterSearch, TwitterSearchImpl):
+    def __init__(self, session, rate_delay, error_delay, max_items, filepath, semaphore=None, **kwargs):
+        """
+        Writes items to a JSONL file like TwitterSearchImpl, fetching them with AsyncTwitterSearch
+        :param session: An aiohttp.ClientSession
+        :param semaphore: An asyncio.Semaphore shared by concurrent searches
+        """
+        TwitterSearchImpl.__init__(self, session, rate_delay, error_delay, max_items, filepath, **kwargs)
+        self.semaphore = semaphore
+        self.headers = {}
+
+    async def search(self, query, target_type, **kwargs):
+        if not self.open_output(query):
+            return
+        completed = False
+        try:
+            await AsyncTwitterSearch.search(self, query, target_type=target_type, max_position=self.max_position,
+                                            **kwargs)
+            completed = not self.cancelled() and not self.failed
+        finally:
+            self.close_output(completed)
+
+
+async def async_twitter_search(searches, rate_delay=DEFAULT_RATE_DELAY, error_delay=DEFAULT_ERROR_DELAY,
+                               limit=DEFAULT_LIMIT, concurrency=DEFAULT_CONCURRENCY, search_options=None, **kwargs):
+    """
+    Runs many searches concurrently on one pooled aiohttp client. Requires the package aiohttp.
+    :param searches: A list of (query, filepath) tuples
+    :param concurrency: Maximum number of searches and requests in flight
+    :param search_options: Options passed on to AsyncTwitterSearchImpl
+    :param kwargs: Passed on to AsyncTwitterSearch.search (target_type, language, user_stats)
+    """
+    search_options = search_options or {}
+    metrics = search_options.get('metrics')
+    import asyncio
+    import aiohttp
+
+    queue = asyncio.Queue()
+    for search in searches:
+        queue.put_nowait(search)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def worker():
+            while not queue.empty():
+                query, filepath = queue.get_nowait()
+                if metrics is not None:
+                    metrics.set_queue_depth("searches", queue.qsize())
+                twit = AsyncTwitterSearchImpl(session, rate_delay, error_delay, limit, filepath,
+                                              semaphore=semaphore, **search_options)
+                logger.info("Search : %s", query)
+                try:
+                    await twit.search(query, **kwargs)
+                except Exception:
+                    logger.exception("%s : Search failed.", filepath)
+
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+
+class TimeSliceSearch(TwitterSearchImpl):
+    # parallel_search searches the rest of the window again instead
+    resumable = False
+
+    def __init__(self, session, rate_delay, error_delay, max_items, filepath, since, until,
+                 split_pages=DENSE_SLICE_PAGES, **kwargs):
+        """
+        Searches a single since/until window and gives up the older part of the window when it turns out dense
+        :param since: Start of the window (datetime, inclusive)
+        :param until: End of the window (datetime, exclusive)
+        :param split_pages: Number of pages after which the remainder of the window is handed back to be split
+        """
+        super(TimeSliceSearch, self).__init__(session, rate_delay, error_delay, max_items, filepath, **kwargs)
+        self.since = since
+        self.until = until
+        self.split_pages = split_pages
+        self.pages = 0
+        self.oldest_epoch = None
+        self.remainder = None
+
+    def unsearched(self):
+        """
+        :return: The (since, until) part of the window the search did not reach, once it gave up on a request
+        """
+        if self.oldest_epoch is None:
+            return self.since, self.until
+        # The oldest second reached may be only partially covered, as with the remainder
+        return self.since, min(self.until, datetime.utcfromtimestamp(self.oldest_epoch + 1))
+
+    def save_items(self, items):
+        continue_search = super(TimeSliceSearch, self).save_items(items)
+        self.pages += 1
+        for item in items:
+            if self.oldest_epoch is None or item.epoch < self.oldest_epoch:
+                self.oldest_epoch = item.epoch
+
+        if continue_search and self.split_pages and self.pages >= self.split_pages and self.oldest_epoch is not None:
+            # The oldest second we reached may be only partially covered, so it is searched again as part of the
+            # remainder and the overlap is removed when the slices are merged
+            remainder_until = datetime.utcfromtimestamp(self.oldest_epoch + 1)
+            if remainder_until < self.until and seconds_between(self.since, remainder_until) >= 2 * MIN_SLICE_SECONDS:
+                self.remainder = (self.since, remainder_until)
+                return False
+        return continue_search
+
+
+def build_query(search_terms=None, since=None, until=None, search_filter=None, since_time=None, until_time=None):
+    """
+    Builds a Twitter advanced search query string
+    :param search_terms: A list of terms
+    :param since: First day of the search (YYYY-MM-DD)
+    :param until: Day at which the search stops (YYYY-MM-DD)
+    :param search_filter: A Twitter search filter (e.g. links, media)
+    :param since_time: Start of the search, in seconds since the epoch, for bounds within a day
+    :param until_time: Time at which the search stops, in seconds since the epoch
+    :return: The query string
+    """
     search_str = ""
 
     if search_terms:
@@ -455,9 +3103,462 @@ def twitter_search(search_terms=None, since=None, until=None, language=None, acc
     if until:
         search_str += " until:" + until
 
+    if since_time is not None:
+        search_str += " since_time:%i" % since_time
+
+    if until_time is not None:
+        search_str += " until_time:%i" % until_time
+
     if search_filter:
         search_str += " filter:" + search_filter
 
+    return search_str
+
+
+def split_date_range(since, until, slices):
+    """
+    Splits a date range into contiguous day-aligned windows, newest first
+    :param since: First day of the range (datetime, inclusive)
+    :param until: Last day of the range (datetime, exclusive)
+    :param slices: Maximum number of windows
+    :return: A list of (since, until) datetime tuples
+    """
+    days = (until - since).days
+    if days <= 0:
+        return []
+    slices = max(1, min(slices, days))
+    step, extra = divmod(days, slices)
+    windows = []
+    end = until
+    for i in range(slices):
+        start = end - timedelta(days=step + (1 if i < extra else 0))
+        windows.append((start, end))
+        end = start
+    return windows
+
+
+def split_time_range(since, until, slices):
+    """
+    Splits a time range into contiguous windows of about the same length, newest first. Unlike split_date_range,
+    the windows can start and end within a day.
+    :param since: Start of the range (datetime, inclusive)
+    :param until: End of the range (datetime, exclusive)
+    :param slices: Maximum number of windows
+    :return: A list of (since, until) datetime tuples
+    """
+    seconds = seconds_between(since, until)
+    if seconds <= 0:
+        return []
+    slices = max(1, min(slices, seconds))
+    step, extra = divmod(seconds, slices)
+    windows = []
+    end = until
+    for i in range(slices):
+        start = end - timedelta(seconds=step + (1 if i < extra else 0))
+        windows.append((start, end))
+        end = start
+    return windows
+
+
+def seconds_between(since, until):
+    return int((until - since).total_seconds())
+
+
+def window_query(search_terms, since, until, search_filter=None):
+    """
+    Builds the query of a since/until window. Windows of whole days use the since: and until: dates, others the
+    since_time: and until_time: epoch seconds.
+    :param since: Start of the window (datetime, inclusive)
+    :param until: End of the window (datetime, exclusive)
+    :return: The query string
+    """
+    if since.time() == until.time() == datetime.min.time():
+        return build_query(search_terms, since.strftime(QUERY_DATE_FORMAT), until.strftime(QUERY_DATE_FORMAT),
+                           search_filter)
+    return build_query(search_terms, search_filter=search_filter, since_time=calendar.timegm(since.timetuple()),
+                       until_time=calendar.timegm(until.timetuple()))
+
+
+def merge_jsonl_parts(part_paths, writer, limit=None, position=None):
+    """
+    Merges newest-first JSONL files into one newest-first output, dropping duplicate items
+    :param part_paths: Paths of the files to merge. Each one must be sorted by descending id
+    :param writer: Writer of the merged output, e.g. a JsonlWriter
+    :param limit: Maximum number of items to keep
+    :param position: A position of the writer to add the merged items after, instead of replacing its output
+    :return: Number of items written
+    """
+    def read_part(part_path):
+        with io.open(part_path, 'r', encoding='utf-8') as part_file:
+            for line in part_file:
+                item = record_from_dict(json.loads(line))
+                yield item.id, item
+
+    counter = 0
+    last_id = None
+    batch = []
+    writer.open(position)
+    for item_id, item in heapq.merge(*[read_part(p) for p in part_paths], key=itemgetter(0), reverse=True):
+        if item_id == last_id:
+            continue
+        last_id = item_id
+        batch.append(item)
+        counter += 1
+        if len(batch) >= PROGRESS_PER:
+            writer.write(batch)
+            writer.flush()
+            batch = []
+        if limit is not None and counter >= limit:
+            break
+    writer.write(batch)
+    writer.close()
+    return counter
+
+
+def parallel_search(search_terms, since, until, filepath, search_filter=None, language=None, workers=4,
+                    rate_delay=DEFAULT_RATE_DELAY, error_delay=DEFAULT_ERROR_DELAY, limit=DEFAULT_LIMIT,
+                    split_pages=DENSE_SLICE_PAGES, search_options=None):
+    """
+    Splits the since/until range into windows and searches them concurrently, then merges the results.
+    Windows that turn out to be dense are split again and resubmitted, so a busy day does not hold up the crawl.
+    Days are split further into windows of down to MIN_SLICE_SECONDS, searched with the since_time: and
+    until_time: operators.
+    :param search_terms: A list of terms
+    :param since: First day of the search (YYYY-MM-DD)
+    :param until: Day at which the search stops (YYYY-MM-DD). Defaults to tomorrow.
+    :param filepath: Path of the merged JSONL output
+    :param workers: Number of windows searched at the same time
+    :param split_pages: Pages fetched by a window before its remainder is split and resubmitted
+    :param search_options: Options passed on to TimeSliceSearch
+    :return: Number of items written, or None if a window could not be searched to the end
+    """
+    import requests
+    # Slices are rebalanced differently on every run, so their checkpoints cannot be resumed. They are written as
+    # plain JSONL and only the merged output goes through the configured sink.
+    search_options = search_options or {}
+    sink = search_options.get('sink', JsonlWriter)
+    search_options = dict(search_options, resume=False, sink=JsonlWriter, high_water_marks=None)
+    metrics = search_options.get('metrics')
+    since_date = datetime.strptime(since, QUERY_DATE_FORMAT)
+    if until:
+        until_date = datetime.strptime(until, QUERY_DATE_FORMAT)
+    else:
+        until_date = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+
+    part_paths = []
+
+    def run_slice(window, part_path):
+        slice_since, slice_until = window
+        search_str = window_query(search_terms, slice_since, slice_until, search_filter)
+        twit = TimeSliceSearch(requests.Session(), rate_delay, error_delay, limit, part_path,
+                               slice_since, slice_until, split_pages=split_pages, **search_options)
+        logger.info("Search : %s", search_str)
+        twit.search(search_str, target_type=DEFAULT_TARGET_TYPE, language=language)
+        if twit.failed:
+            return None, twit.unsearched()
+        return twit.remainder, None
+
+    def submit(executor, window, retries=0):
+        part_path = "%s.part-%04d" % (filepath, len(part_paths))
+        part_paths.append(part_path)
+        future = executor.submit(run_slice, window, part_path)
+        slice_retries[future] = retries
+        return future
+
+    slice_retries = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set(submit(executor, w) for w in split_date_range(since_date, until_date, workers))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                retries = slice_retries.pop(future)
+                remainder, unsearched = future.result()
+                if remainder is not None:
+                    for window in split_time_range(remainder[0], remainder[1], 2):
+                        logger.info("Rebalancing : %s to %s", window[0].isoformat(' '), window[1].isoformat(' '))
+                        pending.add(submit(executor, window))
+                if unsearched is not None:
+                    if retries < SLICE_RETRIES:
+                        logger.warning("Searching again : %s to %s", unsearched[0].isoformat(' '),
+                                       unsearched[1].isoformat(' '))
+                        pending.add(submit(executor, unsearched, retries + 1))
+                    else:
+                        failed.append(unsearched)
+            if metrics is not None:
+                metrics.set_queue_depth("slices", len(pending))
+
+    writer = sink(filepath)
+    # Items of earlier runs are in the seen index and are not searched again, so the output they are in is kept
+    position = writer.end_position() if search_options.get('seen_index') is not None else None
+    counter = merge_jsonl_parts([p for p in part_paths if path.exists(p)], writer, limit=limit, position=position)
+    for part_path in part_paths:
+        if path.exists(part_path):
+            os.remove(part_path)
+        CheckpointStore(part_path).remove()
+    logger.info("%s : %i items merged from %i slices.", filepath, counter, len(part_paths))
+    # The items that were found are kept, so a seen index stays in line with the output
+    for window in sorted(failed):
+        logger.error("%s : Gave up on %s to %s, the output is incomplete. Search it again to complete it.",
+                     filepath, window[0].isoformat(' '), window[1].isoformat(' '))
+    return counter if not failed else None
+
+
+def read_accounts(filepath):
+    """
+    Reads accounts, one per line. Blank lines, comments and a leading @ are ignored.
+    :param filepath: Path of the file, or "-" for stdin
+    :return: A list of screen names
+    """
+    accounts_file = sys.stdin if filepath == "-" else io.open(filepath, 'r', encoding='utf-8')
+    try:
+        accounts = []
+        for line in accounts_file:
+            account = line.split('#', 1)[0].strip().lstrip('@')
+            if account:
+                accounts.append(account)
+        return accounts
+    finally:
+        if accounts_file is not sys.stdin:
+            accounts_file.close()
+
+
+class CrawlScheduler(object):
+    def __init__(self, accounts, search_str="", output_dir=".", output_file=None, workers=DEFAULT_WORKERS,
+                 rate_delay=DEFAULT_RATE_DELAY, error_delay=DEFAULT_ERROR_DELAY, limit=DEFAULT_LIMIT, language=None,
+                 priority=DEFAULT_PRIORITY, status_path=None, search_options=None):
+        """
+        Searches the tweets of many accounts on a pool of workers, each with its own session and User-Agent.
+        Every finished search is appended to a status log. A restart skips the accounts already done for the same
+        query, unless searching incrementally, and picks up interrupted ones from their checkpoints. The first SIGINT
+        lets running searches finish their current page and checkpoint, the second one stops at once.
+        :param accounts: Screen names of the accounts
+        :param search_str: Query the accounts are searched with
+        :param output_dir: Directory of the output files, one per account, and of the status log
+        :param output_file: Write every account to this file instead, one at a time
+        :param workers: Number of accounts searched concurrently
+        :param priority: "staleness" searches the accounts searched longest ago first, "volume" the accounts with
+                         the most items last time first. Accounts never searched go first either way.
+        :param status_path: Path of the status log, CRAWL_STATUS_FILE in output_dir by default
+        :param search_options: Options passed on to TwitterSearchImpl
+        """
+        self.accounts = list(OrderedDict.fromkeys(accounts))
+        self.search_str = search_str
+        self.output_dir = output_dir
+        self.output_file = output_file
+        self.workers = 1 if output_file else workers
+        self.rate_delay = rate_delay
+        self.error_delay = error_delay
+        self.limit = limit
+        self.language = language
+        self.priority = priority
+        self.status_path = status_path if status_path is not None else path.join(output_dir, CRAWL_STATUS_FILE)
+        self.search_options = dict(search_options or {})
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock()
+
+    def query(self, account):
+        return self.search_str + " from:" + account
+
+    def filepath(self, account):
+        return self.output_file if self.output_file else path.join(self.output_dir, account + '.jsonl')
+
+    def load_status(self):
+        """
+        :return: The last status record of every account in the log
+        """
+        status = {}
+        if not path.exists(self.status_path):
+            return status
+        with io.open(self.status_path, 'r', encoding='utf-8') as status_file:
+            for line in status_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line of an interrupted write
+                    continue
+                status[record['account']] = record
+        return status
+
+    def record(self, account, status, **fields):
+        """
+        Appends the status of an account to the log
+        :param account: Screen name of the account
+        :param status: "done", "interrupted" or "failed"
+        """
+        record = dict(fields, account=account, query=self.query(account), status=status, finished_at=int(time()))
+        with self.lock:
+            with io.open(self.status_path, 'a', encoding='utf-8') as status_file:
+                status_file.write(six.text_type(json.dumps(record)) + u'\n')
+
+    def schedule(self):
+        """
+        :return: The accounts to search, in order of priority
+        """
+        status = self.load_status()
+        now = time()
+        accounts = []
+        for account in self.accounts:
+            record = status.get(account)
+            if record is not None and record['status'] == "done" and record['query'] == self.query(account) and \
+                    self.search_options.get('high_water_marks') is None:
+                continue
+            if record is None:
+                staleness = volume = float('inf')
+            else:
+                staleness = now - record['finished_at']
+                volume = record.get('items') or 0
+            key = (-staleness, -volume) if self.priority == "staleness" else (-volume, -staleness)
+            accounts.append((key, account))
+        # sorted() is stable, so accounts with the same priority keep their order
+        return [account for _, account in sorted(accounts, key=itemgetter(0))]
+
+    def interrupt(self, signum, frame):
+        if self.cancel_event.is_set():
+            raise KeyboardInterrupt
+        logger.warning("Interrupted, finishing the current pages. Interrupt again to stop at once.")
+        self.cancel_event.set()
+
+    def crawl(self, account, session):
+        """
+        Searches the tweets of one account, and records how it went
+        """
+        filepath = self.filepath(account)
+        # do not overwrite existing files in output directory, unless we are resuming or appending to them
+        if not self.output_file and not path.exists(filepath + CHECKPOINT_SUFFIX) and \
+                self.search_options.get('high_water_marks') is None and self.search_options.get('seen_index') is None:
+            try:
+                if path.getsize(self.search_options.get('sink', JsonlWriter)(filepath).part_path(0)) > 0:
+                    logger.error('%s : File already has content.', filepath)
+                    return
+            except OSError:
+                pass
+
+        twit = TwitterSearchImpl(session, self.rate_delay, self.error_delay, self.limit, filepath,
+                                 cancel_event=self.cancel_event,
+                                 **dict(self.search_options, resume=True))
+        logger.info("Search : %s", self.query(account))
+        started = time()
+        try:
+            twit.search(self.query(account), target_type=DEFAULT_TARGET_TYPE, language=self.language)
+        except Exception:
+            logger.exception("%s : Search failed.", filepath)
+            self.record(account, "failed", seconds=time() - started)
+            return
+        if twit.failed:
+            status = "failed"
+        elif twit.cancelled():
+            status = "interrupted"
+        else:
+            status = "done"
+        self.record(account, status, items=twit.counter, seconds=time() - started)
+
+    def work(self, accounts):
+        import requests
+        session = requests.Session()
+        metrics = self.search_options.get('metrics')
+        while not self.cancel_event.is_set():
+            try:
+                account = accounts.get_nowait()
+            except queue.Empty:
+                break
+            if metrics is not None:
+                metrics.set_queue_depth("accounts", accounts.qsize())
+            self.crawl(account, session)
+
+    def run(self):
+        """
+        Searches every account that is not done yet, until all are done or the crawl is interrupted
+        :return: Number of accounts left to search
+        """
+        accounts = queue.Queue()
+        scheduled = self.schedule()
+        logger.info("%i accounts to search, %i already done.", len(scheduled), len(self.accounts) - len(scheduled))
+        for account in scheduled:
+            accounts.put(account)
+
+        handler = None
+        if threading.current_thread() is threading.main_thread():
+            handler = signal.signal(signal.SIGINT, self.interrupt)
+        try:
+            threads = [threading.Thread(target=self.work, args=(accounts,), name="crawl-worker-%i" % i)
+                       for i in range(min(self.workers, len(scheduled)))]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                # Wake up now and then, so the main thread can handle signals
+                while thread.is_alive():
+                    thread.join(1)
+        finally:
+            if handler is not None:
+                signal.signal(signal.SIGINT, handler)
+
+        scheduled = set(scheduled)
+        left = len(scheduled) - sum(1 for record in self.load_status().values()
+                                    if record['status'] == "done" and record['account'] in scheduled)
+        if self.cancel_event.is_set():
+            logger.info("Crawl interrupted, %i accounts left. Run again to continue.", left)
+        return left
+
+
+def twitter_search(search_terms=None, since=None, until=None, language=None, accounts=None, search_filter=None,
+                   target_type=DEFAULT_TARGET_TYPE,
+                   rate_delay=DEFAULT_RATE_DELAY, error_delay=DEFAULT_ERROR_DELAY, user_stats=False,
+                   limit=DEFAULT_LIMIT,
+                   output_dir=".", output_file=None, useragent_cache_path=None, useragent_file=None,
+                   workers=DEFAULT_WORKERS, use_async=False, parser=DEFAULT_PARSER,
+                   parse_workers=DEFAULT_PARSE_WORKERS, resume=False, dedup=False, cache_dir=None,
+                   cache_size=DEFAULT_CACHE_SIZE, offline=False, rate_limit=DEFAULT_RATE_LIMIT,
+                   rate_limit_state=None, compression=None, buffer_size=DEFAULT_BUFFER_SIZE, rotate_bytes=None,
+                   rotate_items=None, fsync=False, output_format=DEFAULT_OUTPUT_FORMAT,
+                   row_group_pages=DEFAULT_ROW_GROUP_PAGES, metrics=None, priority=DEFAULT_PRIORITY,
+                   incremental=False):
+    import requests
+    session = requests.Session()
+    if output_format == "parquet" and not rotate_items and (dedup or incremental):
+        # A Parquet file cannot be appended to, new items have to go to new parts
+        logger.error("--dedup and --incremental add to the output, which needs --rotate_items with --format parquet")
+        sys.exit(1)
+    if output_format == "parquet":
+        sink = functools.partial(ParquetWriter, compression=compression or "snappy", row_group_pages=row_group_pages,
+                                 rotate_items=rotate_items)
+    else:
+        sink = functools.partial(JsonlWriter, compression=compression, buffer_size=buffer_size,
+                                 rotate_bytes=rotate_bytes, rotate_items=rotate_items, fsync=fsync)
+    rate_limiter = None
+    if rate_limit:
+        rate_limiter = RateLimiter(rate_limit, state_path=rate_limit_state)
+    cache = None
+    if cache_dir:
+        cache = PageCache(cache_dir, max_bytes=cache_size)
+    elif offline:
+        logger.error("An offline search needs a --cache_dir")
+        sys.exit(1)
+    enricher = None
+    if user_stats and target_type == "users" and not accounts:
+        enricher = UserEnricher()
+    high_water_marks = None
+    if incremental:
+        if target_type != DEFAULT_TARGET_TYPE and not accounts:
+            logger.error("Only tweet searches can be incremental")
+            sys.exit(1)
+        if workers > 1 and not accounts:
+            logger.error("An incremental search cannot be split between workers")
+            sys.exit(1)
+        high_water_marks = HighWaterMarks(path.join(output_dir, HIGH_WATER_MARKS_FILE))
+    seen_index = None
+    if dedup:
+        # The --accounts path always searches tweets
+        index_type = DEFAULT_TARGET_TYPE if accounts else target_type
+        seen_index = SeenIndex(path.join(output_dir, SEEN_INDEX_DIR % index_type))
+    search_options = dict(useragent_cache_path=useragent_cache_path, useragent_file=useragent_file, parser=parser,
+                          parse_workers=parse_workers, resume=resume, seen_index=seen_index, cache=cache,
+                          offline=offline, rate_limiter=rate_limiter, sink=sink, metrics=metrics, enricher=enricher,
+                          high_water_marks=high_water_marks)
+
+    search_str = build_query(search_terms, since, until, search_filter)
+
     if not accounts:
         if not search_terms:
             logger.error("Nothing to search")
@@ -467,8 +3568,23 @@ def twitter_search(search_terms=None, since=None, until=None, language=None, acc
             sys.exit(1)
         else:
             filepath = path.join(output_dir, output_file)
-            twit = TwitterSearchImpl(session, rate_delay, error_delay,
-                                     limit, filepath, useragent_cache_path=useragent_cache_path)
+            if workers > 1 and target_type == DEFAULT_TARGET_TYPE:
+                if not since:
+                    logger.error("A parallel search requires --since")
+                    sys.exit(1)
+                if parallel_search(search_terms, since, until, filepath, search_filter=search_filter,
+                                   language=language, workers=workers, rate_delay=rate_delay, error_delay=error_delay,
+                                   limit=limit, search_options=search_options) is None:
+                    sys.exit(1)
+                return
+            if use_async:
+                import asyncio
+                asyncio.run(async_twitter_search([(search_str, filepath)], rate_delay=rate_delay,
+                                                 error_delay=error_delay, limit=limit, concurrency=1,
+                                                 search_options=search_options, target_type=target_type,
+                                                 user_stats=user_stats, language=language))
+                return
+            twit = TwitterSearchImpl(session, rate_delay, error_delay, limit, filepath, **search_options)
             logger.info("Search : %s", search_str)
             twit.search(search_str, target_type=target_type, user_stats=user_stats, language=language)
     else:
@@ -476,32 +3592,47 @@ def twitter_search(search_terms=None, since=None, until=None, language=None, acc
             logger.error('Output directory does not exist.')
             sys.exit(1)
 
-        for act in accounts:
-            if output_file:
-                filepath = output_file
-            else:
-                filepath = path.join(output_dir, act + '.jsonl')
-                # do not overwrite existing files in output directory
-                try:
-                    if path.getsize(filepath) > 0:
-                        logger.error('%s : File already has content.', filepath)
-                        continue
-                except OSError:
-                    pass
+        if (use_async or workers > 1) and output_file:
+            logger.error('Concurrent account searches need one output file per account.')
+            sys.exit(1)
+
+        if not use_async:
+            scheduler = CrawlScheduler(accounts, search_str, output_dir=output_dir, output_file=output_file,
+                                       workers=workers, rate_delay=rate_delay, error_delay=error_delay, limit=limit,
+                                       language=language, priority=priority, search_options=search_options)
+            scheduler.run()
+            return
 
-            twit = TwitterSearchImpl(session, rate_delay, error_delay,
-                                     limit, filepath, useragent_cache_path=useragent_cache_path)
-            search_str_from = search_str + " from:" + act
-            logger.info("Search : %s", search_str_from)
-            twit.search(search_str_from, target_type=DEFAULT_TARGET_TYPE, language=language)
+        searches = []
+        for act in accounts:
+            filepath = path.join(output_dir, act + '.jsonl')
+            # do not overwrite existing files in output directory, unless we are resuming or appending to them
+            try:
+                if path.getsize(sink(filepath).part_path(0)) > 0 and not incremental and not dedup and \
+                        not (resume and path.exists(filepath + CHECKPOINT_SUFFIX)):
+                    logger.error('%s : File already has content.', filepath)
+                    continue
+            except OSError:
+                pass
+            searches.append((search_str + " from:" + act, filepath))
+
+        if searches:
+            concurrency = workers if workers > 1 else DEFAULT_CONCURRENCY
+            import asyncio
+            asyncio.run(async_twitter_search(searches, rate_delay=rate_delay, error_delay=error_delay, limit=limit,
+                                             concurrency=concurrency, search_options=search_options,
+                                             target_type=DEFAULT_TARGET_TYPE, language=language))
 
 
 def main():
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
     parser = argparse.ArgumentParser()
     parser.add_argument("--search", default=[], nargs='+')
     parser.add_argument("-f", default=DEFAULT_TARGET_TYPE, type=str)
     parser.add_argument("--user_stats", action="store_true", default=False, required=False)
     parser.add_argument('--accounts', nargs='+', required=False)
+    parser.add_argument('--accounts_file', type=str, help="File with one account per line, - for stdin")
+    parser.add_argument('--priority', type=str, choices=PRIORITIES, default=DEFAULT_PRIORITY)
     parser.add_argument('-l', type=str, required=False)
     parser.add_argument("--filter", type=str)
     parser.add_argument("--since", type=str)
@@ -511,14 +3642,66 @@ def main():
     parser.add_argument("--limit", type=int, default=DEFAULT_LIMIT)
     parser.add_argument("--output_dir", type=str, default='.')
     parser.add_argument("--output_file", type=str)
-    parser.add_argument("--fake_useragent_cache_path", type=str, default=fake_useragent_settings.DB)
+    parser.add_argument("--fake_useragent_cache_path", type=str)
+    parser.add_argument("--useragent_file", type=str, help="File with one User-Agent per line, instead of "
+                                                           "fake_useragent")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--async", dest="use_async", action="store_true", default=False, required=False)
+    parser.add_argument("--parser", type=str, choices=PARSERS, default=DEFAULT_PARSER)
+    parser.add_argument("--parse_workers", type=int, default=DEFAULT_PARSE_WORKERS)
+    parser.add_argument("--resume", action="store_true", default=False, required=False)
+    parser.add_argument("--dedup", action="store_true", default=False, required=False)
+    parser.add_argument("--incremental", action="store_true", default=False, required=False,
+                        help="Only search tweets newer than the last complete run of the same query")
+    parser.add_argument("--cache_dir", type=str)
+    parser.add_argument("--cache_size", type=int, default=DEFAULT_CACHE_SIZE)
+    parser.add_argument("--offline", action="store_true", default=False, required=False)
+    parser.add_argument("--rate_limit", type=float, default=DEFAULT_RATE_LIMIT)
+    parser.add_argument("--rate_limit_state", type=str)
+    parser.add_argument("--compression", type=str, choices=COMPRESSIONS)
+    parser.add_argument("--buffer_size", type=int, default=DEFAULT_BUFFER_SIZE)
+    parser.add_argument("--rotate_size", type=int)
+    parser.add_argument("--rotate_items", type=int)
+    parser.add_argument("--fsync", action="store_true", default=False, required=False)
+    parser.add_argument("--format", type=str, choices=OUTPUT_FORMATS, default=DEFAULT_OUTPUT_FORMAT)
+    parser.add_argument("--row_group_pages", type=int, default=DEFAULT_ROW_GROUP_PAGES)
+    parser.add_argument("--metrics_port", type=int)
+    parser.add_argument("--metrics_file", type=str)
+    parser.add_argument("--metrics_interval", type=float, default=DEFAULT_METRICS_INTERVAL)
     args = parser.parse_args()
 
-    twitter_search(target_type=args.f, search_terms=args.search, since=args.since, until=args.until, language=args.l,
-                   accounts=args.accounts, search_filter=args.filter, rate_delay=args.rate_delay,
-                   error_delay=args.error_delay, limit=args.limit,
-                   output_dir=args.output_dir, output_file=args.output_file, user_stats=args.user_stats,
-                   useragent_cache_path=args.fake_useragent_cache_path)
+    accounts = args.accounts
+    if args.accounts_file:
+        accounts = (accounts or []) + read_accounts(args.accounts_file)
+
+    metrics = None
+    exporters = []
+    if args.metrics_port is not None or args.metrics_file:
+        metrics = Metrics()
+        if args.metrics_port is not None:
+            exporters.append(PrometheusExporter(metrics, args.metrics_port))
+        if args.metrics_file:
+            exporters.append(JsonMetricsExporter(metrics, args.metrics_file, interval=args.metrics_interval))
+    for exporter in exporters:
+        exporter.start()
+
+    try:
+        twitter_search(target_type=args.f, search_terms=args.search, since=args.since, until=args.until,
+                       language=args.l, accounts=accounts, search_filter=args.filter, rate_delay=args.rate_delay,
+                       error_delay=args.error_delay, limit=args.limit,
+                       output_dir=args.output_dir, output_file=args.output_file, user_stats=args.user_stats,
+                       useragent_cache_path=args.fake_useragent_cache_path, useragent_file=args.useragent_file,
+                       workers=args.workers,
+                       use_async=args.use_async, parser=args.parser, parse_workers=args.parse_workers,
+                       resume=args.resume, dedup=args.dedup, cache_dir=args.cache_dir, cache_size=args.cache_size,
+                       offline=args.offline, rate_limit=args.rate_limit, rate_limit_state=args.rate_limit_state,
+                       compression=args.compression, buffer_size=args.buffer_size, rotate_bytes=args.rotate_size,
+                       rotate_items=args.rotate_items, fsync=args.fsync, output_format=args.format,
+                       row_group_pages=args.row_group_pages, metrics=metrics, priority=args.priority,
+                       incremental=args.incremental)
+    finally:
+        for exporter in exporters:
+            exporter.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,557 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import tempfile
+import threading
+import tracemalloc
+import gzip
+import importlib.util
+import os
+from os import path
+from time import sleep, perf_counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlencode, urlparse, parse_qs
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import TwitterScraper
+from TwitterScraper import TwitterSearch, TwitterSearchImpl, JsonlWriter, RetryEngine, RetryPolicy, \
+    default_retry_policies, encode_items, PARSERS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGES = 50
+DEFAULT_REPEAT = 3
+ITEMS_PER_PAGE = 20
+DEFAULT_LATENCY = 0.005  # seconds the mock server waits before answering
+DEFAULT_THROTTLE_EVERY = 10  # the mock server answers every n-th request with a 429
+FIRST_TWEET_ID = 1234567890123456789
+FIRST_EPOCH = 1583020800
+# Run in a fresh interpreter by bench_startup: imports TwitterScraper, then fetches and parses one page
+STARTUP_SCRIPT = """
+import json
+import sys
+from time import perf_counter
+started = perf_counter()
+import TwitterScraper
+imported = perf_counter()
+import requests
+search = TwitterScraper.TwitterSearch(requests.Session(), 0, 0, parser=sys.argv[2])
+search.session.headers.update(search.search_headers())
+items = search.item_parser("tweets")(search.execute_search(sys.argv[1])['items_html'])
+json.dump({'import': imported - started, 'first_page': perf_counter() - started, 'items': len(items)}, sys.stdout)
+"""
+# Run in a fresh interpreter by bench_parse_rss: parses the pages in a JSON file, keeping the items
+PARSE_RSS_SCRIPT = """
+import json
+import sys
+import TwitterScraper
+def peak_rss():
+    # Linux carries ru_maxrss over from the parent process, VmHWM is the peak of this one only
+    try:
+        with open('/proc/self/status') as status:
+            return [int(line.split()[1]) * 1024 for line in status if line.startswith('VmHWM:')][0]
+    except (IOError, IndexError):
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+with open(sys.argv[1]) as pages_file:
+    pages = json.load(pages_file)
+parse_fn = getattr(TwitterScraper.TwitterSearch, sys.argv[2])
+before = peak_rss()
+parsed = [parse_fn(items_html) for items_html in pages]
+json.dump({'before': before, 'after': peak_rss()}, sys.stdout)
+"""
+PARSE_FUNCTIONS = {
+    ("bs4", "tweets"): TwitterSearch.parse_tweets,
+    ("bs4", "users"): TwitterSearch.parse_users,
+    ("lxml", "tweets"): TwitterSearch.parse_tweets_lxml,
+    ("lxml", "users"): TwitterSearch.parse_users_lxml,
+    ("stream", "tweets"): TwitterSearch.parse_tweets_stream,
+    ("stream", "users"): TwitterSearch.parse_users_stream,
+}
+
+
+def tweet_html(tweet_id, epoch, photos=0, card=None):
+    """
+    Renders a tweet the way the search timeline does
+    :param tweet_id: Id of the tweet
+    :param epoch: Time of the tweet
+    :param photos: Number of attached photos
+    :param card: None, or the card2 name, e.g. "summary_large_image" or "player"
+    :return: The HTML of the stream item
+    """
+    user_id = tweet_id % 100000
+    media = ''.join('<div class="AdaptiveMedia-photoContainer js-adaptive-photo" '
+                    'data-image-url="https://pbs.twimg.com/media/%i_%i.jpg"><img src="x"></div>' % (tweet_id, k)
+                    for k in range(photos))
+    if card is not None:
+        media += ('<div class="card2 js-media-container" data-card2-name="%s">'
+                  '<div class="js-macaw-cards-iframe-container" data-src="/i/cards/tfw/v1/%i"></div></div>'
+                  % (card, tweet_id))
+    return ('<li class="js-stream-item stream-item stream-item" data-item-id="%i" data-item-type="tweet">'
+            '<div class="tweet js-stream-tweet js-actionable-tweet" data-tweet-id="%i" data-screen-name="user%i" '
+            'data-name="User %i" data-user-id="%i"><div class="content">'
+            '<small class="time"><a href="/user%i/status/%i" class="tweet-timestamp">'
+            '<span class="_timestamp js-short-timestamp" data-time="%i">Mar 1</span></a></small>'
+            '<div class="js-tweet-text-container"><p class="TweetTextSize js-tweet-text tweet-text" lang="en">'
+            'Benchmarking <a href="/hashtag/python" class="twitter-hashtag pretty-link js-nav"><s>#</s>'
+            '<b>python</b></a> parsers &amp; friends '
+            '<a href="https://t.co/abc" class="twitter-timeline-link" data-expanded-url="https://example.com/%i">'
+            '<span class="invisible">https://</span>example.com</a>'
+            '<a href="https://t.co/pic" class="twitter-timeline-link u-hidden">pic.twitter.com/pic</a></p></div>'
+            '%s<div class="ProfileTweet-actionCountList u-hiddenVisually">'
+            '<span class="ProfileTweet-actionCount"><span class="ProfileTweet-actionCountForAria">1,234 replies'
+            '</span></span><span class="ProfileTweet-actionCount"><span class="ProfileTweet-actionCountForAria">'
+            '56 retweets</span></span><span class="ProfileTweet-actionCount">'
+            '<span class="ProfileTweet-actionCountForAria">789 likes</span></span></div></div></div></li>\n'
+            % (tweet_id, tweet_id, user_id, user_id, user_id, user_id, tweet_id, epoch, tweet_id, media))
+
+
+def user_html(user_id, verified=False):
+    """
+    Renders a user the way the users search timeline does
+    :param user_id: Id of the user
+    :param verified: Whether the user is verified
+    :return: The HTML of the stream item
+    """
+    return ('<div class="js-stream-item stream-item" data-item-id="%i"><div class="ProfileCard js-actionable-user">'
+            '<div class="user-actions btn-group" data-screen-name="user%i" data-name="User %i"></div>'
+            '<div class="ProfileCard-userFields">%s<p class="ProfileCard-bio u-dir">Writes about '
+            '<a href="/hashtag/python">#python</a> and <a href="/user%i">@user%i</a></p></div></div></div>\n'
+            % (user_id, user_id, user_id, '<span class="Icon Icon--verified"></span>' if verified else '',
+               user_id + 1, user_id + 1))
+
+
+def fixture_page(fixture, page):
+    """
+    :param fixture: "plain", "media" (four photos per tweet), "cards" (every tweet has a card) or "users"
+    :param page: Number of the page, the newest is 0
+    :return: The items_html of the page
+    """
+    first = page * ITEMS_PER_PAGE
+    if fixture == "users":
+        return ''.join(user_html(1000000 - first - i, verified=i % 5 == 0) for i in range(ITEMS_PER_PAGE))
+    html = []
+    for i in range(first, first + ITEMS_PER_PAGE):
+        photos = 4 if fixture == "media" else 0
+        card = ("summary_large_image" if i % 2 else "player") if fixture == "cards" else None
+        html.append(tweet_html(FIRST_TWEET_ID - i, FIRST_EPOCH - i * 60, photos=photos, card=card))
+    return ''.join(html)
+
+
+def synthetic_fixtures(pages):
+    """
+    :param pages: Number of pages of each fixture
+    :return: Lists of items_html by fixture name, with the target type of each fixture
+    """
+    fixtures = {}
+    for fixture in ("plain", "media", "cards", "users"):
+        target_type = "users" if fixture == "users" else "tweets"
+        fixtures[fixture] = (target_type, [fixture_page(fixture, page) for page in range(pages)])
+    return fixtures
+
+
+def recorded_fixtures(cache_dir):
+    """
+    Loads the pages recorded by a search run with --cache_dir
+    :param cache_dir: Directory of the page cache
+    :return: Lists of items_html by fixture name, with the target type of each fixture
+    """
+    fixtures = {"recorded_tweets": ("tweets", []), "recorded_users": ("users", [])}
+    for root, _, names in os.walk(cache_dir):
+        for name in sorted(names):
+            if not name.endswith('.json.gz'):
+                continue
+            with gzip.open(path.join(root, name), 'rb') as page_file:
+                entry = json.loads(page_file.read().decode('utf-8'))
+            items_html = (entry['response'] or {}).get('items_html')
+            if items_html:
+                target_type = parse_qs(urlparse(entry['url']).query).get('f', ["tweets"])[0]
+                fixtures["recorded_" + target_type][1].append(items_html)
+    return dict((name, fixture) for name, fixture in fixtures.items() if fixture[1])
+
+
+def peak_rss():
+    """
+    :return: Peak resident set size of this process in bytes, or None where it cannot be measured
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def bench_parse(parse_fn, pages, repeat):
+    """
+    Measures the throughput of a parser, and the memory it allocates
+    :param parse_fn: Parser, e.g. TwitterSearch.parse_tweets
+    :param pages: List of items_html
+    :param repeat: Number of timed runs, the fastest counts
+    :return: Dictionary of results
+    """
+    seconds = None
+    items = 0
+    for _ in range(repeat):
+        start = perf_counter()
+        items = sum(len(parse_fn(items_html)) for items_html in pages)
+        elapsed = perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+    # Keep the parsed items alive, so retained bytes are what a buffered pipeline would hold on to
+    tracemalloc.start()
+    parsed = [parse_fn(items_html) for items_html in pages]
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del parsed
+
+    return {
+        'pages': len(pages),
+        'items': items,
+        'seconds': seconds,
+        'items_per_sec': items / seconds if seconds else None,
+        'pages_per_sec': len(pages) / seconds if seconds else None,
+        'alloc_peak_bytes': peak,
+        'alloc_retained_bytes': retained,
+        'alloc_retained_bytes_per_item': retained / items if items else None,
+    }
+
+
+def bench_parse_rss(parse_fn, pages):
+    """
+    Measures the peak resident set size of a parser in a new process, so earlier benchmarks do not hide it
+    :param parse_fn: Parser, e.g. TwitterSearch.parse_tweets
+    :param pages: List of items_html
+    :return: Dictionary of results, empty where the RSS cannot be measured
+    """
+    if resource is None:
+        return {}
+    pages_file = tempfile.NamedTemporaryFile(mode='w', suffix=".json", delete=False)
+    try:
+        with pages_file:
+            json.dump(pages, pages_file)
+        output = subprocess.check_output([sys.executable, '-c', PARSE_RSS_SCRIPT, pages_file.name, parse_fn.__name__],
+                                         cwd=path.dirname(path.abspath(__file__)))
+    finally:
+        os.remove(pages_file.name)
+    run = json.loads(output.decode('utf-8'))
+    return {
+        'peak_rss_bytes': run['after'],
+        # What parsing, including the import of the backend, added to the process with the pages loaded
+        'peak_rss_growth_bytes': run['after'] - run['before'],
+    }
+
+
+def bench_serialize(items, repeat, directory):
+    """
+    Measures how fast items are serialized by each sink
+    :param items: List of Tweet or User records
+    :param repeat: Number of timed runs, the fastest counts
+    :param directory: Directory for the output files
+    :return: Dictionary of results by serializer
+    """
+    def timed(fn):
+        seconds = None
+        for _ in range(repeat):
+            start = perf_counter()
+            fn()
+            elapsed = perf_counter() - start
+            seconds = elapsed if seconds is None else min(seconds, elapsed)
+        return seconds
+
+    def write(sink):
+        writer = sink(path.join(directory, "serialize.jsonl"))
+        writer.open()
+        for i in range(0, len(items), ITEMS_PER_PAGE):
+            writer.write(items[i:i + ITEMS_PER_PAGE])
+            writer.flush()
+        writer.close()
+
+    serializers = {
+        'encode_items': lambda: encode_items(items),
+        'jsonl': lambda: write(JsonlWriter),
+        'jsonl_gzip': lambda: write(lambda filepath: JsonlWriter(filepath, compression="gzip")),
+    }
+    if importlib.util.find_spec("pyarrow") is not None:
+        serializers['parquet'] = lambda: write(TwitterScraper.ParquetWriter)
+    else:
+        logger.info("pyarrow is not installed, skipping the Parquet sink")
+
+    results = {'bytes': len(encode_items(items))}
+    for name, fn in sorted(serializers.items()):
+        seconds = timed(fn)
+        results[name] = {
+            'seconds': seconds,
+            'items_per_sec': len(items) / seconds if seconds else None,
+        }
+    return results
+
+
+class MockTwitterHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            throttle = server.throttle_every and server.requests % server.throttle_every == 0
+            if throttle:
+                server.throttled += 1
+        sleep(server.latency)
+        if throttle:
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.end_headers()
+            return
+
+        # Pages are numbered, max_position is the number of the next one
+        params = parse_qs(urlparse(self.path).query)
+        page = int(params.get('max_position', ["0"])[0])
+        items_html = server.pages[page] if page < len(server.pages) else ""
+        body = json.dumps({
+            'has_more_items': page + 1 < len(server.pages),
+            'items_html': items_html,
+            'min_position': str(page + 1),
+            'new_latent_count': ITEMS_PER_PAGE,
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockTwitterServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, pages, latency=DEFAULT_LATENCY, throttle_every=DEFAULT_THROTTLE_EVERY):
+        """
+        Serves paginated search timeline responses on localhost, from a background thread
+        :param pages: List of items_html, one per page
+        :param latency: Seconds to wait before each response
+        :param throttle_every: Answer every n-th request with HTTP 429, 0 to never throttle
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', 0), MockTwitterHandler)
+        self.pages = pages
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return "http://%s:%i/i/search/timeline" % self.server_address
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class BenchmarkSearch(TwitterSearchImpl):
+    def __init__(self, base_url, *args, **kwargs):
+        """
+        A search against a MockTwitterServer
+        :param base_url: URL of the mock server
+        """
+        super(BenchmarkSearch, self).__init__(*args, **kwargs)
+        self.base_url = base_url
+
+    def construct_url(self, query, target_type, max_position=None, language=None):
+        params = {'f': target_type, 'q': query}
+        if max_position is not None:
+            params['max_position'] = max_position
+        return self.base_url + '?' + urlencode(params)
+
+
+def bench_search(pages, target_type, directory, latency, throttle_every, parser, parse_workers=0):
+    """
+    Runs TwitterSearchImpl.search end to end against a MockTwitterServer
+    :param pages: List of items_html served by the mock server
+    :param target_type: Can be "tweets" or "users"
+    :param directory: Directory for the output file
+    :param latency: Seconds the mock server waits before each response
+    :param throttle_every: The mock server answers every n-th request with HTTP 429
+    :param parser: Parser backend
+    :param parse_workers: Number of parse processes, 0 parses in the fetching thread
+    :return: Dictionary of results
+    """
+    retries = []
+    policies = default_retry_policies(error_delay=0.01)
+    policies[429] = RetryPolicy(base=0.01, cap=0.05)
+    retry_engine = RetryEngine(policies=policies, listeners=(retries.append,))
+    filepath = path.join(directory, "search.jsonl")
+
+    import requests
+    with MockTwitterServer(pages, latency=latency, throttle_every=throttle_every) as server:
+        search = BenchmarkSearch(server.url, requests.Session(), 0, 0, None, filepath, parser=parser,
+                                 parse_workers=parse_workers, retry_engine=retry_engine)
+        start = perf_counter()
+        search.search("benchmark", target_type, language=None, user_stats=False)
+        seconds = perf_counter() - start
+
+    return {
+        'pages': len(pages),
+        'items': search.counter,
+        'seconds': seconds,
+        'items_per_sec': search.counter / seconds if seconds else None,
+        'requests': server.requests,
+        'throttled': server.throttled,
+        'retries': len(retries),
+        'output_bytes': path.getsize(filepath),
+    }
+
+
+def bench_startup(pages, repeat, parser):
+    """
+    Measures how long a new process takes to import TwitterScraper and to get its first page of tweets, which is
+    most of the runtime of short jobs
+    :param pages: List of items_html served by the mock server
+    :param repeat: Number of processes started, the fastest counts
+    :param parser: Parser backend
+    :return: Dictionary of results, in seconds
+    """
+    directory = path.dirname(path.abspath(__file__))
+    runs = []
+    with MockTwitterServer(pages, latency=0, throttle_every=0) as server:
+        url = server.url + '?' + urlencode({'f': "tweets", 'q': "benchmark"})
+        for _ in range(repeat):
+            start = perf_counter()
+            output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT, url, parser], cwd=directory)
+            run = json.loads(output.decode('utf-8'))
+            run['process'] = perf_counter() - start
+            runs.append(run)
+
+    return {
+        'import_seconds': min(run['import'] for run in runs),
+        'first_page_seconds': min(run['first_page'] for run in runs),
+        'process_seconds': min(run['process'] for run in runs),
+        'items': runs[0]['items'],
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=path.dirname(path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(pages=DEFAULT_PAGES, repeat=DEFAULT_REPEAT, recorded=None, search=True, latency=DEFAULT_LATENCY,
+                   throttle_every=DEFAULT_THROTTLE_EVERY, parse_workers=0):
+    """
+    Runs all benchmarks
+    :param pages: Number of pages of each synthetic fixture
+    :param repeat: Number of timed runs of each benchmark, the fastest counts
+    :param recorded: Directory of a page cache with recorded pages to benchmark as well
+    :param search: Whether to run the end-to-end search benchmarks
+    :param latency: Seconds the mock server waits before each response
+    :param throttle_every: The mock server answers every n-th request with HTTP 429
+    :param parse_workers: Also run the end-to-end search with this many parse processes
+    :return: Dictionary of results
+    """
+    fixtures = synthetic_fixtures(pages)
+    if recorded is not None:
+        fixtures.update(recorded_fixtures(recorded))
+
+    results = {
+        'commit': git_commit(),
+        'date': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parse': {},
+        'serialize': {},
+        'search': {},
+        'startup': {},
+    }
+
+    for parser in PARSERS:
+        logger.info("Starting up with %s", parser)
+        results['startup'][parser] = bench_startup(fixtures["plain"][1], repeat, parser)
+
+    for fixture, (target_type, fixture_pages) in sorted(fixtures.items()):
+        results['parse'][fixture] = {}
+        for parser in PARSERS:
+            parse_fn = PARSE_FUNCTIONS[(parser, target_type)]
+            logger.info("Parsing %s with %s", fixture, parser)
+            results['parse'][fixture][parser] = bench_parse(parse_fn, fixture_pages, repeat)
+            results['parse'][fixture][parser].update(bench_parse_rss(parse_fn, fixture_pages))
+
+    directory = tempfile.mkdtemp(prefix="benchmark")
+    try:
+        for fixture, (target_type, fixture_pages) in sorted(fixtures.items()):
+            parse_fn = PARSE_FUNCTIONS[("lxml", target_type)]
+            items = [item for items_html in fixture_pages for item in parse_fn(items_html)]
+            logger.info("Serializing %s", fixture)
+            results['serialize'][fixture] = bench_serialize(items, repeat, directory)
+
+        if search:
+            target_type, fixture_pages = fixtures["media"]
+            for parser in PARSERS:
+                logger.info("Searching with %s", parser)
+                results['search'][parser] = bench_search(fixture_pages, target_type, directory, latency,
+                                                         throttle_every, parser)
+            if parse_workers:
+                logger.info("Searching with %i parse workers", parse_workers)
+                results['search']['pipeline'] = bench_search(fixture_pages, target_type, directory, latency,
+                                                             throttle_every, "lxml", parse_workers=parse_workers)
+    finally:
+        for name in os.listdir(directory):
+            os.remove(path.join(directory, name))
+        os.rmdir(directory)
+
+    results['peak_rss_bytes'] = peak_rss()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks startup, parsing, serialization and the search loop, "
+                                                 "and prints the results as JSON")
+    parser.add_argument("--pages", type=int, default=DEFAULT_PAGES, help="Pages of each synthetic fixture")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--recorded", type=str, default=None,
+                        help="Page cache directory (see --cache_dir) with recorded pages to benchmark as well")
+    parser.add_argument("--no_search", action="store_false", dest="search", default=True)
+    parser.add_argument("--latency", type=float, default=DEFAULT_LATENCY)
+    parser.add_argument("--throttle_every", type=int, default=DEFAULT_THROTTLE_EVERY)
+    parser.add_argument("--parse_workers", type=int, default=0)
+    parser.add_argument("-o", "--output", type=str, default=None, help="Write the results here instead of stdout")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s',
+                        level=logging.INFO if args.verbose else logging.WARNING)
+
+    results = run_benchmarks(pages=args.pages, repeat=args.repeat, recorded=args.recorded, search=args.search,
+                             latency=args.latency, throttle_every=args.throttle_every,
+                             parse_workers=args.parse_workers)
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
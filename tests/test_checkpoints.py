@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Runs searches against the MockTwitterServer of the benchmark, and checks that checkpoints, resuming and incremental
+runs leave every tweet in the output exactly once.
+"""
+
+import io
+import json
+import shutil
+import sys
+import tempfile
+import unittest
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import requests  # noqa: E402
+
+from TwitterScraper import CheckpointStore, HighWaterMarks, JsonlWriter, RetryEngine, RetryPolicy, \
+    default_retry_policies  # noqa: E402
+from benchmark import BenchmarkSearch, MockTwitterServer, ITEMS_PER_PAGE, tweet_html  # noqa: E402
+
+FIRST_ID = 1000000
+FIRST_EPOCH = 1583020800
+QUERY = "checkpoints"
+
+
+class Crash(Exception):
+    pass
+
+
+class CrashingSearch(BenchmarkSearch):
+    def __init__(self, crash_after, *args, **kwargs):
+        """
+        A search whose process dies once it has saved crash_after items
+        """
+        super(CrashingSearch, self).__init__(*args, **kwargs)
+        self.crash_after = crash_after
+
+    def checkpoint(self, max_position, done=False):
+        if self.counter >= self.crash_after:
+            # The page reaches the file, but not its checkpoint
+            self.writer.flush(force=True)
+            raise Crash()
+        super(CrashingSearch, self).checkpoint(max_position, done=done)
+
+    def close_output(self, completed):
+        # A dead process does not close anything
+        self.writer.file.close()
+
+
+def tweet_pages(ids):
+    """
+    :param ids: Ids of the tweets, newest first
+    :return: List of items_html, one per page
+    """
+    tweets = [tweet_html(tweet_id, FIRST_EPOCH + tweet_id - FIRST_ID) for tweet_id in ids]
+    return [''.join(tweets[i:i + ITEMS_PER_PAGE]) for i in range(0, len(tweets), ITEMS_PER_PAGE)]
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="checkpoints")
+        self.filepath = path.join(self.directory, "search.jsonl")
+        self.useragent_file = path.join(self.directory, "useragents.txt")
+        with io.open(self.useragent_file, 'w') as useragent_file:
+            useragent_file.write(u"Mozilla/5.0 (tests)\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def search(self, server, search_class=BenchmarkSearch, args=(), max_items=None, **kwargs):
+        """
+        Runs a search of QUERY against the server, flushing and checkpointing every page
+        :return: The search
+        """
+        policies = default_retry_policies(error_delay=0.001)
+        # Give up on the first HTTP 429
+        policies[429] = RetryPolicy(max_attempts=0)
+        search = search_class(*(args + (server.url, requests.Session(), 0, 0, max_items, self.filepath)),
+                              useragent_file=self.useragent_file, retry_engine=RetryEngine(policies=policies),
+                              sink=lambda filepath: JsonlWriter(filepath, buffer_size=0), **kwargs)
+        search.search(QUERY, "tweets", language=None)
+        return search
+
+    def output_ids(self):
+        with io.open(self.filepath, 'r', encoding='utf-8') as output:
+            return [json.loads(line)['id'] for line in output]
+
+    def test_resume_after_crash(self):
+        ids = list(range(FIRST_ID, FIRST_ID - 200, -1))
+        with MockTwitterServer(tweet_pages(ids), latency=0, throttle_every=0) as server:
+            with self.assertRaises(Crash):
+                self.search(server, CrashingSearch, args=(100,))
+            # The page written after the last checkpoint is on disk
+            self.assertEqual(len(self.output_ids()), 100)
+            self.assertEqual(CheckpointStore(self.filepath).load()['counter'], 80)
+
+            search = self.search(server, resume=True)
+        self.assertEqual(search.counter, 200)
+        self.assertEqual(self.output_ids(), ids)
+        self.assertTrue(CheckpointStore(self.filepath).load()['done'])
+
+    def test_request_given_up(self):
+        ids = list(range(FIRST_ID, FIRST_ID - 200, -1))
+        with MockTwitterServer(tweet_pages(ids), latency=0, throttle_every=4) as server:
+            search = self.search(server)
+            self.assertTrue(search.failed)
+            checkpoint = CheckpointStore(self.filepath).load()
+            self.assertFalse(checkpoint['done'])
+            self.assertEqual(checkpoint['counter'], 3 * ITEMS_PER_PAGE)
+
+            server.throttle_every = 0
+            search = self.search(server, resume=True)
+        self.assertFalse(search.failed)
+        self.assertEqual(self.output_ids(), ids)
+        self.assertTrue(CheckpointStore(self.filepath).load()['done'])
+
+    def test_incremental_limit_fills_gap(self):
+        marks = HighWaterMarks(path.join(self.directory, "marks.json"))
+        old_ids = list(range(FIRST_ID, FIRST_ID - 200, -1))
+        with MockTwitterServer(tweet_pages(old_ids), latency=0, throttle_every=0) as server:
+            self.search(server, high_water_marks=marks)
+            self.assertEqual(marks.get(QUERY)['id'], FIRST_ID)
+
+            new_ids = list(range(FIRST_ID + 100, FIRST_ID, -1))
+            server.pages = tweet_pages(new_ids + old_ids)
+            # Each run continues where the last one stopped, and the mark only moves once the gap is filled
+            for run in range(3):
+                search = self.search(server, max_items=30, high_water_marks=marks)
+                self.assertEqual(search.counter, 30)
+                self.assertEqual(marks.get(QUERY)['id'], FIRST_ID)
+            search = self.search(server, max_items=30, high_water_marks=marks)
+            self.assertEqual(search.counter, 10)
+            self.assertEqual(marks.get(QUERY)['id'], FIRST_ID + 100)
+
+            search = self.search(server, max_items=30, high_water_marks=marks)
+            self.assertEqual(search.counter, 0)
+        output_ids = self.output_ids()
+        self.assertEqual(len(output_ids), len(set(output_ids)))
+        self.assertEqual(sorted(output_ids, reverse=True), new_ids + old_ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Checks every parser backend against the saved pages in fixtures/: each page has the records parse_tweets or
+parse_users produced for it, one JSON object per line.
+"""
+
+import io
+import json
+import os
+import sys
+import unittest
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from TwitterScraper import TwitterSearch, item_to_dict  # noqa: E402
+
+FIXTURES_DIR = path.join(path.dirname(path.abspath(__file__)), 'fixtures')
+PARSE_FUNCTIONS = {
+    "tweets": {
+        "bs4": TwitterSearch.parse_tweets,
+        "lxml": TwitterSearch.parse_tweets_lxml,
+        "stream": TwitterSearch.parse_tweets_stream,
+    },
+    "users": {
+        "bs4": TwitterSearch.parse_users,
+        "lxml": TwitterSearch.parse_users_lxml,
+        "stream": TwitterSearch.parse_users_stream,
+    },
+}
+
+
+def load_fixture(name):
+    """
+    :param name: The name of the fixture, without extension
+    :return: The HTML of the page, and the list of records expected from it
+    """
+    with io.open(path.join(FIXTURES_DIR, name + '.html'), encoding='utf-8') as f:
+        items_html = f.read()
+    with io.open(path.join(FIXTURES_DIR, name + '.jsonl'), encoding='utf-8') as f:
+        expected = [json.loads(line) for line in f if line.strip()]
+    return items_html, expected
+
+
+def fixture_names():
+    return sorted(name[:-len('.html')] for name in os.listdir(FIXTURES_DIR) if name.endswith('.html'))
+
+
+class ParserTest(unittest.TestCase):
+    def check_fixtures(self, target_type):
+        names = [name for name in fixture_names() if name.startswith(target_type)]
+        self.assertTrue(names)
+        for name in names:
+            items_html, expected = load_fixture(name)
+            for parser, parse_fn in sorted(PARSE_FUNCTIONS[target_type].items()):
+                items = [item_to_dict(item) for item in parse_fn(items_html)]
+                self.assertEqual(items, expected, "%s parser differs on %s" % (parser, name))
+
+    def test_tweets(self):
+        self.check_fixtures("tweets")
+
+    def test_users(self):
+        self.check_fixtures("users")
+
+    def test_empty_page(self):
+        for target_type, parse_functions in sorted(PARSE_FUNCTIONS.items()):
+            for parser, parse_fn in sorted(parse_functions.items()):
+                self.assertEqual(list(parse_fn('')), [], "%s parser on an empty %s page" % (parser, target_type))
+                self.assertEqual(list(parse_fn(' \n')), [], "%s parser on a blank %s page" % (parser, target_type))
+
+
+if __name__ == '__main__':
+    unittest.main()